@@ -0,0 +1,276 @@
+import re
+import json
+import math
+import time
+import zlib
+import hashlib
+import threading
+import click
+from io import BytesIO
+from http.server import (ThreadingHTTPServer, BaseHTTPRequestHandler)
+from urllib.parse import (urlparse, parse_qs)
+from PIL import Image
+
+# A local stand-in for the library, serving a synthetic collection: a tree of documents with the same pages,
+# manifests, lists of children and DeepZoom tiles as the real server, so that grabs can be run and measured
+# without sending a single request to the library. Run it on its own with `python benchmarks/fakeserver.py`.
+
+ARK_PREFIX = 'ark:/73873/pf'
+WIDTH = 3000 # in pixels, all the images of the collection share the same pixels
+HEIGHT = 2200
+TILE_SIZE = 256
+OVERLAP = 1
+FANOUT = 5 # Number of children of each document
+DEPTH = 2 # Number of levels of documents below the root
+IMAGES = 3 # Number of images of each document
+PROPERTIES = 20 # Number of properties of each document
+MENU_LINKS = 300 # The menus make up most of a page of the library
+JPEG_QUALITY = 90
+
+
+def ark(iid):
+    return f'{ARK_PREFIX}{iid:010d}'
+
+
+def picture_list(iid, n_images):
+    return [{'deepZoomManifest': f'in/dz/pf{iid:010d}_{k}.xml', 'pagination': f'p{k}', 'description': f'Image {k}'}
+            for k in range(1, n_images + 1)]
+
+
+def document_page(iid, parent_iid='', n_images=IMAGES, n_properties=PROPERTIES, n_links=MENU_LINKS):
+    # A document page shaped like the ones of the library: a large menu, a few scripts and the properties
+    links = ''.join(f'<li class="menu"><a href="/in/faces/browse.xhtml?id={k}">Collection {k}</a></li>\n'
+                    for k in range(n_links))
+    scripts = ''.join(f'<script>\nvar option{k} = "{k}";\nfunction f{k}() {{ return option{k}; }}\n</script>\n'
+                      for k in range(10))
+    properties = ''.join(f'<div class="NormalField property_field{k}"><div><span>Field {k}</span></div>'
+                         f'<div><div>Value of the field {k} of document {iid} &amp; more</div></div></div>\n'
+                         for k in range(n_properties))
+    return f'''<html><head><title>Document {iid}</title>{scripts}</head><body>
+<ul>{links}</ul>
+<script>
+var zmat = "CollectionIconography";
+var instanceiid = "{iid:010d}";
+var parent_iid = "{parent_iid}";
+var currLocale = "fr";
+var pictureList = {json.dumps(picture_list(iid, n_images))};
+</script>
+{properties}
+</body></html>'''
+
+
+def viewer_page(iid, image_number, n_images=IMAGES):
+    return f'''<html><body><script>
+var iid = "{iid:010d}";
+var ark = "{ark(iid)}/v{image_number:04d}";
+var pictureList = {json.dumps(picture_list(iid, n_images))};
+</script></body></html>'''
+
+
+class FakeLibrary:
+
+    # The collection served by the fake server. The documents form a tree numbered like a heap:
+    # the root is document 1 and the children of document n are fanout * (n - 1) + 2 to fanout * n + 1.
+    # Every request waits latency seconds. A share error_rate of the requests fails with a 503 error,
+    # chosen from a hash of the url and of the number of times it was requested, so that a run can be repeated.
+    def __init__(self, width=WIDTH, height=HEIGHT, tile_size=TILE_SIZE, overlap=OVERLAP, fanout=FANOUT, depth=DEPTH,
+                 n_images=IMAGES, latency=0, error_rate=0):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.fanout = fanout
+        self.depth = depth
+        self.n_images = n_images
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_zoom = 10 + math.floor(math.log2(max(width, height) / tile_size))
+        self.requests = {} # Number of requests by url
+        self.__tiles = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def n_documents(self):
+        return sum(self.fanout ** d for d in range(self.depth + 1))
+
+    def document_depth(self, iid):
+        depth = 0
+        while iid > 1:
+            iid = (iid - 2) // self.fanout + 1
+            depth += 1
+        return depth
+
+    def exists(self, iid):
+        return iid >= 1 and self.document_depth(iid) <= self.depth
+
+    def children(self, iid):
+        if self.document_depth(iid) >= self.depth:
+            return []
+        first = self.fanout * (iid - 1) + 2
+        return list(range(first, first + self.fanout))
+
+    def parent(self, iid):
+        return (iid - 2) // self.fanout + 1 if iid > 1 else None
+
+    def tile(self, zoom_level, col, row):
+        # Tiles are rendered once and kept in memory, so that the server does not slow down the client it measures
+        key = zoom_level, col, row
+        data = self.__tiles.get(key)
+        if data is None:
+            data = self.__render(zoom_level, col, row)
+            with self.__lock:
+                self.__tiles[key] = data
+        return data
+
+    def warm(self):
+        # Renders all the tiles ahead of the measures
+        for zoom_level in range(self.max_zoom + 1):
+            width, height = self.__level_size(zoom_level)
+            if not (width and height):
+                continue
+            for col in range(math.ceil(width / self.tile_size)):
+                for row in range(math.ceil(height / self.tile_size)):
+                    self.tile(zoom_level, col, row)
+
+    def __level_size(self, zoom_level):
+        factor = 2 ** (self.max_zoom - zoom_level)
+        return self.width // factor, self.height // factor
+
+    def __render(self, zoom_level, col, row):
+        if zoom_level > self.max_zoom:
+            return None
+        width, height = self.__level_size(zoom_level)
+        t_size = self.tile_size
+        left = col * t_size - (self.overlap if col else 0)
+        top = row * t_size - (self.overlap if row else 0)
+        if left >= width or top >= height:
+            return None
+        right = min((col + 1) * t_size + self.overlap, width)
+        bottom = min((row + 1) * t_size + self.overlap, height)
+        # Gradients, cheap to compute and the same on every run
+        size = (right - left, bottom - top)
+        gradient = Image.linear_gradient('L')
+        image = Image.merge('RGB', (gradient.resize(size), gradient.rotate(90).resize(size),
+                                    Image.radial_gradient('L').resize(size)))
+        buffer = BytesIO()
+        image.save(buffer, 'JPEG', quality=JPEG_QUALITY)
+        return buffer.getvalue()
+
+    def fails(self, url):
+        with self.__lock:
+            n = self.requests[url] = self.requests.get(url, 0) + 1
+        if not self.error_rate:
+            return False
+        return zlib.crc32(f'{url}#{n}'.encode()) / 2 ** 32 < self.error_rate
+
+    def manifest(self):
+        payload = {'Image': {'Format': 'jpg', 'Size': {'Width': self.width, 'Height': self.height},
+                             'Overlap': self.overlap, 'TileSize': self.tile_size}}
+        return json.dumps(json.dumps(payload)) # The library answers with a JSON string holding the JSON manifest
+
+    def geoquery(self, parent_iid, page, page_size):
+        children = self.children(int(parent_iid)) if parent_iid.isdigit() and self.exists(int(parent_iid)) else []
+        page_children = children[(page - 1) * page_size:page * page_size]
+        results = [{'InterviewId': {'value': ark(iid)}} for iid in page_children]
+        return '(' + json.dumps({'results': results}) + ');\r\n'
+
+
+class FakeLibraryHandler(BaseHTTPRequestHandler):
+
+    library = None # Set by serve()
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the real server
+    disable_nagle_algorithm = True # Otherwise the headers and the body sent apart wait for the delayed ACK of the client
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        library = self.library
+        if library.latency:
+            time.sleep(library.latency)
+        if library.fails(self.path):
+            return self.__send(b'Service Unavailable', 'text/plain', 503)
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        m = re.match(r'/ark:/73873/pf(\d{10})(?:/v(\d+))?$', url.path)
+        if m:
+            iid = int(m.group(1))
+            if not library.exists(iid):
+                return self.__send(b'Not Found', 'text/plain', 404)
+            if m.group(2):
+                return self.__send(viewer_page(iid, int(m.group(2)), library.n_images))
+            parent = library.parent(iid)
+            return self.__send(document_page(iid, f'{parent:010d}' if parent else '', library.n_images))
+        if url.path.endswith('/pictureListSVC/getTileSource'):
+            return self.__send(library.manifest(), 'application/json')
+        if url.path.endswith('/searchSVC/jsonp/geoquery'):
+            parent_iid = re.search(r'parent_iid:"([^"]*)"', query['fq'][0]).group(1)
+            return self.__send(library.geoquery(parent_iid, int(query['pageNo'][0]), int(query['pageSize'][0])),
+                               'application/javascript')
+        m = re.match(r'/in/dz/[^/]+/(\d+)/(\d+)_(\d+)\.jpg$', url.path)
+        if m:
+            data = library.tile(*map(int, m.groups()))
+            if data is None:
+                return self.__send(b'Not Found', 'text/plain', 404)
+            return self.__send(data, 'image/jpeg')
+        self.__send(b'Not Found', 'text/plain', 404)
+
+    def __send(self, body, content_type='text/html; charset=utf-8', status=200):
+        if isinstance(body, str):
+            body = body.encode()
+        etag = None
+        if status == 200 and not content_type.startswith('image'):
+            # Pages and manifests can be revalidated, like on the library
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(library, host='127.0.0.1', port=0):
+    # Serves the library in a background thread, returns the server and its root url.
+    # Stop it with server.shutdown().
+    handler = type('Handler', (FakeLibraryHandler,), {'library': library})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-library', daemon=True).start()
+    return server, f'http://{host}:{server.server_port}'
+
+
+@click.command()
+@click.option("--port", default=8000, type=int, show_default=True)
+@click.option("--fanout", default=FANOUT, type=int, show_default=True, help="The number of children of each document.")
+@click.option("--depth", default=DEPTH, type=int, show_default=True, help="The number of levels of documents.")
+@click.option("--images", default=IMAGES, type=int, show_default=True, help="The number of images of each document.")
+@click.option("--latency", default=0.0, type=float, show_default=True, help="In seconds, the delay of each request.")
+@click.option("--error-rate", default=0.0, type=float, show_default=True,
+              help="The share of the requests failing with a 503 error.")
+def main(port, fanout, depth, images, latency, error_rate):
+    """Serves a synthetic collection like the library, e.g. to grab its root document:
+
+    grabs --root-url http://127.0.0.1:8000 -r -s http://127.0.0.1:8000/ark:/73873/pf0000000001
+    """
+    library = FakeLibrary(fanout=fanout, depth=depth, n_images=images, latency=latency, error_rate=error_rate)
+    library.warm()
+    server, root = serve(library, port=port)
+    click.echo(f'Serving {library.n_documents} documents at {root}/{ark(1)}, press Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
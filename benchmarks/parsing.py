@@ -0,0 +1,53 @@
+import sys
+import time
+import click
+from pathlib import Path
+from bs4 import BeautifulSoup
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from grabs.resource import (HtmlPage, DocumentBuilder, get_js_var, HTML_PARSER)
+from fakeserver import document_page
+
+DOCUMENT_VARS = ('zmat', 'instanceiid', 'parent_iid', 'currLocale', 'pictureList')
+SAMPLE_URL = 'http://localhost/ark:/73873/pf0000000001'
+
+
+def parse_before(text):
+    # The parsing of a document page before the HtmlPage layer: a full parse with html.parser,
+    # a regex per variable on the whole text of the page, then a walk through the tree.
+    soup = BeautifulSoup(text, features='html.parser')
+    source_txt = soup.text
+    js_vars = {name: get_js_var(source_txt, name) for name in DOCUMENT_VARS}
+    return js_vars, soup.findAll("div", {"class": "NormalField"})
+
+
+def parse_after(text):
+    builder = DocumentBuilder(SAMPLE_URL, source=HtmlPage(text))
+    return builder._read_document()
+
+
+def timeit(fn, pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in pages:
+            fn(text)
+    return (time.perf_counter() - start) / (repeat * len(pages))
+
+
+@click.command()
+@click.argument('pages', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('-n', '--repeat', default=20, show_default=True, help='Number of times each page is parsed.')
+def main(pages, repeat):
+    """Compares the time taken to parse document pages, before and after the HtmlPage layer.
+
+    The PAGES are document pages saved from the library, a synthetic page is used if none is given.
+    """
+    texts = [Path(page).read_text(encoding='utf-8') for page in pages] or [document_page(1, n_images=50, n_properties=30, n_links=500)]
+    before = timeit(parse_before, texts, repeat)
+    after = timeit(parse_after, texts, repeat)
+    click.echo(f'{len(texts)} page(s), {sum(map(len, texts)) // len(texts)} characters on average, parser {HTML_PARSER}')
+    click.echo(f'before: {before * 1000:.2f} ms per page')
+    click.echo(f'after:  {after * 1000:.2f} ms per page ({before / after:.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import statistics
+import subprocess
+import multiprocessing
+import logging
+import click
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+sys.path.insert(0, str(ROOT_DIR / 'benchmarks'))
+import grabs
+import cli
+import fakeserver
+
+try:
+    import resource as rusage
+except ImportError:
+    rusage = None
+
+# Runs the benchmarks of grabs against the fake library of benchmarks/fakeserver.py, served from another process
+# so that it does not compete with grabs for the GIL, and writes the results to a JSON file:
+#   python benchmarks/run.py -o before.json
+#   ... change grabs ...
+#   python benchmarks/run.py -o after.json --compare before.json
+# Each benchmark is run --repeat times and the median of each measure is kept. The measures ending with
+# _per_second are better when higher, the others (seconds, MiB) when lower.
+
+REPEAT = 5
+LATENCY = 0.01 # in seconds, added to every request by the fake server
+DEPTH = 3 # Levels of documents below the root, 156 documents with the default fanout
+UNTILE_ROUNDS = 5 # Number of times the image is untiled in each run, so that a run lasts a few seconds
+NOISE = 10 # in percent, smaller changes are usually noise and are not marked by --compare
+BENCHMARKS = ('untile', 'untile_stream', 'memory', 'crawl', 'cli')
+IMAGE_URL = f'{fakeserver.ark(1)}/v0001'
+
+
+def run_server(options, ready):
+    library = fakeserver.FakeLibrary(**options)
+    library.warm()
+    server, root = fakeserver.serve(library)
+    ready.put(root)
+    while True:
+        time.sleep(3600)
+
+
+def start_server(options):
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    process = context.Process(target=run_server, args=(options, ready), daemon=True)
+    process.start()
+    return process, ready.get(timeout=60)
+
+
+def peak_memory_mib():
+    # The peak resident memory of the process. VmHWM is used on Linux, since ru_maxrss is
+    # inherited from the parent process, whose peak may be higher than the one measured.
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if rusage is None:
+        return None
+    unit = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss is in bytes on macOS, in KiB elsewhere
+    return rusage.getrusage(rusage.RUSAGE_SELF).ru_maxrss * unit / 1024 ** 2
+
+
+def build_image(root):
+    transport = grabs.Transport(root=root)
+    return grabs.resource.TiledImageBuilder(viewer_url=f'{root}/{IMAGE_URL}', transport=transport).build()
+
+
+def untile(root, stream_to=None):
+    im = build_image(root)
+    n_tiles = len(grabs.untiler._UntileQuery(im, im.max_zoom).tiles_urls())
+    success_rates = []
+    start = time.perf_counter()
+    for _ in range(UNTILE_ROUNDS):
+        success_rates.append(im.content(caching=False, stream_to=stream_to).success_rate)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'tiles_per_second': UNTILE_ROUNDS * n_tiles / seconds,
+            'megapixels_per_second': UNTILE_ROUNDS * im.width * im.height / 1e6 / seconds,
+            'success_rate': min(success_rates)}
+
+
+def bench_untile(root, workdir):
+    return untile(root)
+
+
+def bench_untile_stream(root, workdir):
+    return untile(root, stream_to=str(Path(workdir) / 'image.tif'))
+
+
+def bench_memory(root, workdir):
+    # The peak memory of a process only grows, so each untiling and the crawl are measured in a process of their own
+    if peak_memory_mib() is None:
+        return {}
+    results = {}
+    for mode in ('memory', 'stream', 'crawl'):
+        output = subprocess.run([sys.executable, __file__, 'peak-memory', root, mode, workdir],
+                                check=True, capture_output=True, text=True).stdout
+        results[f'peak_{mode}_mib'] = float(output.strip().splitlines()[-1])
+    return results
+
+
+def bench_crawl(root, workdir):
+    transport = grabs.Transport(root=root)
+    start = time.perf_counter()
+    n_docs = sum(1 for _ in grabs.crawl(f'{root}/{fakeserver.ark(1)}', transport=transport))
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'documents_per_second': n_docs / seconds}
+
+
+def bench_cli(root, workdir):
+    out_dir = Path(workdir) / 'cli'
+    args = ['-s', f'{root}/{fakeserver.ark(1)}', '-r', '-d', '1', '-z', '11', '-o', str(out_dir), '--root-url', root,
+            '--no-cache', '--no-metadata-cache']
+    start = time.perf_counter()
+    cli.grab.main(args, standalone_mode=False)
+    seconds = time.perf_counter() - start
+    n_images = len(list(out_dir.glob('*.jpg')))
+    return {'seconds': seconds, 'images_per_second': n_images / seconds}
+
+
+def median_results(samples):
+    return {name: statistics.median(sample[name] for sample in samples) for name in samples[0]}
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT_DIR, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    click.echo(f'{"measure":<42} {"baseline":>12} {"current":>12} {"change":>8}')
+    for bench, measures in results['benchmarks'].items():
+        for name, value in measures.items():
+            before = baseline['benchmarks'].get(bench, {}).get(name)
+            if before is None:
+                continue
+            change = (value - before) / before * 100 if before else 0
+            better = change > 0 if name.endswith('_per_second') else change < 0
+            mark = ('+' if better else '-') if abs(change) >= NOISE else ' '
+            click.echo(f'{bench + "." + name:<42} {before:>12.3f} {value:>12.3f} {change:>+7.1f}% {mark}')
+
+
+@click.group(invoke_without_command=True)
+@click.option("--output", "-o", default=None, type=click.Path(dir_okay=False),
+              help="Write the results to this JSON file.")
+@click.option("--compare", "baseline_path", default=None, type=click.Path(exists=True, dir_okay=False),
+              help="The results of a previous run, to compare with.")
+@click.option("--repeat", "-n", default=REPEAT, type=int, show_default=True,
+              help="Number of times each benchmark is run.")
+@click.option("--only", "benchmarks", multiple=True, type=click.Choice(BENCHMARKS),
+              help="Run only this benchmark. Repeat it to run several benchmarks.")
+@click.option("--latency", default=LATENCY, type=float, show_default=True,
+              help="In seconds, the delay of each request of the fake server.")
+@click.option("--error-rate", default=0.0, type=float, show_default=True,
+              help="The share of the requests failing with a 503 error.")
+@click.pass_context
+def main(ctx, output, baseline_path, repeat, benchmarks, latency, error_rate):
+    """Measures grabs against a local fake library."""
+    if ctx.invoked_subcommand:
+        return
+    logging.getLogger().setLevel(logging.ERROR)
+    cli.log.setLevel(logging.ERROR)
+    cli.log.disabled = True # grab sets its own level
+
+    options = {'latency': latency, 'error_rate': error_rate, 'depth': DEPTH}
+    server, root = start_server(options)
+    results = {'version': version(), 'python': platform.python_version(), 'platform': platform.platform(),
+               'cpus': os.cpu_count(), 'server': dict(options, width=fakeserver.WIDTH, height=fakeserver.HEIGHT,
+                                                       documents=fakeserver.FakeLibrary(depth=DEPTH).n_documents),
+               'repeat': repeat, 'benchmarks': {}}
+    try:
+        for bench in benchmarks or BENCHMARKS:
+            samples = []
+            for _ in range(repeat):
+                with tempfile.TemporaryDirectory() as workdir:
+                    samples.append(globals()[f'bench_{bench}'](root, workdir))
+            results['benchmarks'][bench] = median_results(samples)
+            click.echo(f'{bench}: ' + ', '.join(f'{name} {value:.3f}' for name, value in results['benchmarks'][bench].items()))
+    finally:
+        server.terminate()
+
+    if output:
+        Path(output).write_text(json.dumps(results, indent=2))
+    if baseline_path:
+        compare(results, json.loads(Path(baseline_path).read_text()))
+
+
+@main.command('peak-memory', hidden=True)
+@click.argument('root')
+@click.argument('mode')
+@click.argument('workdir')
+def peak_memory(root, mode, workdir):
+    # Prints the memory taken by one untiling, or by the crawl of the whole collection in crawl mode,
+    # on top of the peak memory of the process before it, in MiB
+    if mode == 'crawl':
+        transport = grabs.Transport(root=root)
+        before = peak_memory_mib()
+        for _ in grabs.crawl(f'{root}/{fakeserver.ark(1)}', transport=transport):
+            pass
+    else:
+        im = build_image(root)
+        before = peak_memory_mib()
+        im.content(caching=False, stream_to=str(Path(workdir) / 'peak.tif') if mode == 'stream' else None)
+    click.echo(f'{peak_memory_mib() - before:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,20 @@
 import click
 import grabs
+import requests
 import re
-import dataclasses, json
+import json
 import logging
-import concurrent.futures as cf
+import itertools
+import threading
+from collections import Counter
 from pathlib import Path
 
 logging.basicConfig(format="%(message)s") # Root logger
 log = logging.getLogger('cli') # Local logger
 
-MAX_WORKERS = 5
-FETCH_TIMEOUT = 20
+METADATA_WORKERS = 2 # Number of sources resolved at once
+MAX_WORKERS = 5 # Number of images untiled at once
+WRITER_WORKERS = 2 # Number of images saved at once
 
 
 def make_path(directory, file_name):
@@ -18,21 +22,216 @@ def make_path(directory, file_name):
 
 
 def serialize_json(dataclass_instance):
-    return json.dumps(dataclasses.asdict(dataclass_instance), indent=2, sort_keys=True, ensure_ascii=False)
+    as_dict = grabs.catalog.as_dict(dataclass_instance)
+    return json.dumps(as_dict, indent=2, sort_keys=True, ensure_ascii=False)
 
 
-def get_save_image(path_out, im, zoom_level):
-    log.info(f'Grabbing image {im.file_name} [zoom level = {zoom_level}]')
-    imdata, success_rate = im.content(zoom_level)
-    im_file_name = im.file_name
-    path = make_path(path_out, im_file_name)
+def save_metadata(path_out, element, src):
+    serialized = serialize_json(element)
+    md_file_name = element.ark or src
+    path = make_path(path_out, md_file_name)
+    with open(path, 'w') as md_file:
+        md_file.write(serialized)
+        log.debug(f'Metadata saved to {path}')
 
-    if success_rate < 1:
-        log.warning(f'\033[1mParts of the untiled image {im.file_name} are missing.' \
-                    f'You could try again by calling grabs with the image\'s url {im.viewer_url}\033[0m')
 
-    imdata.save(path)
-    log.debug(f'Image {im.id} saved to {path}')
+def region_suffix(region):
+    # An area of an image is saved apart from the whole image, and journaled apart too
+    return '_region' + '-'.join(map(str, region)) if region else ''
+
+
+def image_path(path_out, im, stream=False, zoom_level=None, region=None):
+    # The zoom level is appended to the file name when an image is saved at several zoom levels
+    stem, suffix = Path(im.file_name).stem, '.tif' if stream else Path(im.file_name).suffix
+    if zoom_level is not None:
+        stem += f'_z{zoom_level}'
+    return make_path(path_out, stem + region_suffix(region) + suffix)
+
+
+def parse_region(ctx, param, value):
+    # x0,y0,x1,y1 in pixels, or in fractions of the size of the images if any value has decimals,
+    # e.g. 0.5,0.5,1,1. The fractions must be between 0 and 1, pixels and fractions cannot be mixed.
+    if value is None:
+        return None
+    values = value.split(',')
+    try:
+        if len(values) != 4:
+            raise ValueError
+        if not any('.' in v for v in values):
+            return tuple(int(v) for v in values)
+        region = tuple(float(v) for v in values)
+    except ValueError:
+        raise click.BadParameter(f'expected x0,y0,x1,y1, got {value}')
+    if not all(0 <= v <= 1 for v in region):
+        raise click.BadParameter(f'expected pixels or fractions between 0 and 1, got {value}')
+    return region
+
+
+# The file of the image at each zoom level. The levels where the region is smaller than a pixel are left out,
+# see Untiler.level_regions
+def image_paths(path_out, im, zoom_levels, stream=False, region=None):
+    if len(zoom_levels) == 1:
+        return {zoom_levels[0]: image_path(path_out, im, stream, region=region)}
+    if region:
+        zoom_levels = grabs.untiler.Untiler.level_regions(im, zoom_levels, region)
+    return {zoom_level: image_path(path_out, im, stream, zoom_level, region) for zoom_level in zoom_levels}
+
+
+# Returns the list of the (path, result) of the image untiled at each zoom level.
+# Unless stream is set, the images are not saved yet, see save_image.
+def untile_image(path_out, im, zoom_levels, tile_workers=None, stream=False, caching=True,
+                 repair_retries=grabs.untiler.REPAIR_RETRIES, region=None):
+    log.info(f'Grabbing image {im.file_name} [zoom level = {", ".join(map(str, zoom_levels))}]')
+    paths = image_paths(path_out, im, zoom_levels, stream, region)
+
+    # If stream is set, the image is written to the file while it is untiled
+    if len(zoom_levels) == 1:
+        zoom_level = zoom_levels[0]
+        results = {zoom_level: im.content(zoom_level, workers=tile_workers, stream_to=paths[zoom_level] if stream else None,
+                                          caching=caching, region=region)}
+    else:
+        # The lower zoom levels are computed from the tiles of the highest one.
+        # A region in pixels is given at the highest zoom level, and scaled down to the others.
+        stream_to = image_path(path_out, im, stream, '{zoom}', region) if stream else None
+        results = im.pyramid(zoom_levels, workers=tile_workers, stream_to=stream_to, caching=caching, region=region)
+
+    untiled = []
+    for zoom_level, result in results.items():
+        if result.failed_tiles and repair_retries:
+            result = im.repair(result, retries=repair_retries, workers=tile_workers)
+        if result.success_rate < 1:
+            log.warning(f'\033[1mParts of the untiled image {im.file_name} are missing.' \
+                        f'You could try again by calling grabs with the image\'s url {im.viewer_url}\033[0m')
+        untiled.append((paths[zoom_level], result))
+    return untiled
+
+
+def save_image(im, untiled, stream=False):
+    for path, result in untiled:
+        if not stream:
+            grabs.untiler.save_image(result.content, path)
+        log.debug(f'Image {im.id} saved to {path}')
+
+
+# Returns the list of the (path, result) of the directory of the tiles of each zoom level
+def mirror_image(path_out, im, zoom_levels=None, tile_workers=None, caching=True,
+                 repair_retries=grabs.untiler.REPAIR_RETRIES, region=None):
+    log.info(f'Mirroring the tiles of image {im.file_name}')
+    paths = mirror_paths(path_out, im, zoom_levels, region)
+    mirrored = []
+    for zoom_level, result in im.mirror(path_out, zoom_levels, workers=tile_workers, caching=caching, region=region).items():
+        if result.failed_tiles and repair_retries:
+            result = im.repair(result, retries=repair_retries, workers=tile_workers)
+        if result.success_rate < 1:
+            log.warning(f'\033[1mSome tiles of the image {im.file_name} at zoom level {zoom_level} are missing.' \
+                        f'You could try again by calling grabs with the image\'s url {im.viewer_url}\033[0m')
+        mirrored.append((paths[zoom_level], result))
+    log.debug(f'Tiles of image {im.id} mirrored to {path_out}')
+    return mirrored
+
+
+def read_sources(lines):
+    # One url per line, or one JSON object per line with the url in its "url" field
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if not line.startswith('{'):
+            yield line
+            continue
+        try:
+            url = json.loads(line).get('url')
+        except (ValueError, AttributeError):
+            url = None
+        if url:
+            yield url
+        else:
+            log.error(f'ERROR: No url found in the line {line}')
+
+
+class DocumentJob:
+
+    # A document or image being grabbed. It is recorded in the journal once its n_parts parts,
+    # i.e. its images and its record in the catalog, are saved.
+    # Only what the journal needs is kept, not the element, whose properties and images may be large.
+    def __init__(self, key, element, journal, n_parts, with_images):
+        self.key = key
+        self.children_urls = list(getattr(element, 'children_urls', []))
+        self.journal = journal
+        self.with_images = with_images
+        self.n_pending = n_parts
+        self.n_incomplete = 0
+        self.__lock = threading.Lock()
+        if not n_parts:
+            self.__finish()
+
+    def done(self, complete=True):
+        with self.__lock:
+            self.n_pending -= 1
+            self.n_incomplete += 0 if complete else 1
+            finished = not self.n_pending
+        if finished:
+            self.__finish()
+
+    def __finish(self):
+        # Incomplete images are grabbed again on resume, only their missing tiles are downloaded
+        if not self.n_incomplete:
+            self.journal.add('document', self.key, children_urls=self.children_urls, with_images=self.with_images)
+
+
+def response_cache(metadata_cache_dir=None, metadata_ttl=grabs.cache.RESPONSE_TTL, no_metadata_cache=False, offline=False):
+    if no_metadata_cache:
+        if offline:
+            raise click.UsageError('--offline reads the metadata from the cache, it cannot be used with --no-metadata-cache.')
+        return None
+    return grabs.ResponseCache(metadata_cache_dir or grabs.cache.RESPONSES_DIR, metadata_ttl)
+
+
+def collect_stats(show_stats=False, stats_file=None):
+    # The metrics of the run are only collected if they are reported
+    if not (show_stats or stats_file):
+        return None
+    collector = grabs.metrics.Metrics()
+    grabs.metrics.add_collector(collector)
+    return collector
+
+
+def report_stats(collector, show_stats=False, stats_file=None):
+    if collector is None:
+        return
+    grabs.metrics.remove_collector(collector)
+    if stats_file:
+        collector.write(stats_file)
+    if not show_stats:
+        return
+    summary = collector.summary()
+    lines = [f'Run took {summary["elapsed_seconds"]:.1f}s, {collector.total("tiles_total")} tiles '
+             f'({summary["tiles_per_second"]:.1f} tiles/s), '
+             f'{collector.total("response_bytes_total") / 1024 ** 2:.1f} MiB received']
+    for counter in summary['counters']:
+        lines.append(f'  {metric_name(counter)}: {counter["value"]}')
+    for histogram in summary['histograms']:
+        lines.append(f'  {metric_name(histogram)}: {histogram["count"]} x {histogram["mean"]:.3f}s on average, '
+                     f'p50 {histogram["p50"]:.3f}s, p95 {histogram["p95"]:.3f}s, max {histogram["max"]:.3f}s')
+    log.info('\n'.join(lines))
+
+
+def metric_name(metric):
+    labels = ', '.join(f'{k}={v}' for k, v in metric['labels'].items())
+    return f'{metric["name"]} ({labels})' if labels else metric['name']
+
+
+# The directory of the tiles of each level mirrored, where the region is appended to tell the tiles of
+# a region from the whole level in the journal
+def mirror_paths(path_out, im, zoom_levels=None, region=None):
+    return {zoom_level: str(Path(path_out) / f'{Path(im.file_name).stem}_files' / str(zoom_level)) + region_suffix(region)
+            for zoom_level in grabs.untiler.Untiler.mirror_levels(im, zoom_levels, region)}
+
+
+# The images are journaled by their path in the output directory, which holds the journal,
+# so that a job can be resumed however the directory is written
+def journal_path(path_out, path):
+    return Path(path).relative_to(path_out).as_posix()
 
 
 def print_end_message(out_dir, n_docs, n_img=0, success_img=0):
@@ -42,80 +241,425 @@ def print_end_message(out_dir, n_docs, n_img=0, success_img=0):
     log.info(msg)
 
 @click.command()
-@click.option("--src", "-s", required=True,
-              help="The URL of the document to retrieve.",
+@click.option("--src", "-s", "srcs", multiple=True,
+              help="The URL of the document to retrieve. Repeat it to retrieve several documents.",
 )
+@click.option("--batch", "-b", default=None, type=click.File('r'),
+              help="A file listing the URLs of the documents to retrieve, '-' to read them from the standard input. "
+              + "One URL per line, or one JSON object per line with the URL in its \"url\" field.")
 @click.option("--out-dir", "-o", default=".",
               help="Path to a directory where the documents data will be stored. Default in the current folder.")
-@click.option("--zoom-level", "-z", default=None, type=int,
+@click.option("--catalog", "catalog_path", default=None, type=click.Path(dir_okay=False),
+              help="Save the metadata of the documents and images to this catalog instead of one JSON file per document: "
+              + "a SQLite database (.sqlite, .db) or a file of one JSON record per line (.ndjson, .jsonl).")
+@click.option("--zoom-level", "-z", "zoom_levels", multiple=True, type=int,
               help="The zoom level at which the images will be downloaded. "
               + "If not specified, the maximum zoom level for each image will be used. "
-              + "The minimum zoom level is usually 10.")
+              + "The minimum zoom level is usually 10. Repeat it to save each image at several zoom levels, "
+              + "e.g. -z 13 -z 11: only the tiles of the highest level are downloaded.")
 @click.option("--recursive", "-r", is_flag=True, default=False,
               help="Download the sub-documents of the document set with -s.")
+@click.option("--depth", "-d", default=None, type=int,
+              help="With -r, the number of levels of sub-documents to download. "
+              + "If not specified, the whole tree of sub-documents is downloaded.")
 @click.option("--no-images", "-x", is_flag=True, default=False,
               help="If set, only the metadata of images will be downloaded.")
+@click.option("--tile-workers", "-t", default=None, type=int,
+              help="The number of tiles downloaded at once for each image. Default to 8.")
+@click.option("--metadata-workers", default=METADATA_WORKERS, type=int, show_default=True,
+              help="The number of documents and images whose metadata are fetched at once.")
+@click.option("--image-workers", default=MAX_WORKERS, type=int, show_default=True,
+              help="The number of images downloaded at once.")
+@click.option("--writer-workers", default=WRITER_WORKERS, type=int, show_default=True,
+              help="The number of images saved to files at once.")
+@click.option("--max-rate", default=None, type=float,
+              help="The maximum number of requests per second sent to the server. "
+              + "The number of requests sent at once is adapted to the errors and latency of the server anyway.")
+@click.option("--max-bandwidth", default=None, type=int,
+              help="The maximum number of KiB per second downloaded from the server.")
+@click.option("--processes", "-p", default=None, type=int,
+              help="Decode the tiles in this number of processes, to use several CPU cores. "
+              + "Default to decoding in the threads downloading the tiles.")
+@click.option("--region", default=None, callback=parse_region,
+              help="Only grab the area x0,y0,x1,y1 of the images, in pixels at the highest zoom level grabbed, "
+              + "or in fractions of their width and height if any value has decimals, e.g. 0.5,0.5,1,1. "
+              + "Only the tiles of this area are downloaded, the area is saved to a file of its own. "
+              + "The pixels are scaled down to the lower zoom levels.")
+@click.option("--mirror", is_flag=True, default=False,
+              help="Save the original tiles of the images as they are, with a DeepZoom .dzi file, "
+              + "instead of untiling them. All the zoom levels are saved, unless set with -z.")
+@click.option("--stream", is_flag=True, default=False,
+              help="Write the images to uncompressed TIFF files row of tiles by row of tiles, "
+              + "instead of assembling them in memory. Use it for very large images.")
+@click.option("--cache-dir", default=None, type=click.Path(file_okay=False),
+              help="Path to a directory where the downloaded tiles are cached. "
+              + "Default to grabs/tiles in the user cache directory.")
+@click.option("--cache-size", default=2048, type=int, show_default=True,
+              help="The maximum size of the tiles cache, in MiB. The least recently used tiles are removed first.")
+@click.option("--no-cache", is_flag=True, default=False,
+              help="Do not read or save the tiles in the cache.")
+@click.option("--metadata-cache-dir", default=None, type=click.Path(file_okay=False),
+              help="Path to a directory where the pages, manifests and lists of sub-documents are cached. "
+              + "Default to grabs/responses in the user cache directory.")
+@click.option("--metadata-ttl", default=grabs.cache.RESPONSE_TTL, type=int, show_default=True,
+              help="In seconds, how long the cached metadata are used without asking the server. "
+              + "After that, they are only downloaded again if the server tells they changed.")
+@click.option("--no-metadata-cache", is_flag=True, default=False,
+              help="Do not read or save the metadata in the cache.")
+@click.option("--offline", is_flag=True, default=False,
+              help="Do not send any request, only use the metadata and tiles in the caches.")
+@click.option("--repair-retries", default=grabs.untiler.REPAIR_RETRIES, type=int, show_default=True,
+              help="How many times the tiles that could not be downloaded are fetched again, "
+              + "before the image is saved with missing parts.")
+@click.option("--resume", is_flag=True, default=False,
+              help="Resume a job interrupted in the same output directory: the documents and images "
+              + "already saved are skipped. The tiles of the images left unfinished are not journaled, "
+              + "they are only not downloaded again if they are still in the tiles cache.")
+@click.option("--stats", "show_stats", is_flag=True, default=False,
+              help="Print a summary of the requests, tiles and time spent in each step at the end.")
+@click.option("--stats-file", default=None, type=click.Path(dir_okay=False),
+              help="Write the metrics of the run to this file, as JSON if it ends with .json, "
+              + "in the Prometheus text format otherwise (e.g. grabs.prom for the textfile collector).")
+@click.option("--root-url", default=grabs.transport.BS_ROOT, show_default=True,
+              help="The root URL of the library, e.g. to grab from a local test server.")
 @click.option("--verbose", "-v", is_flag=True, default=False,
               help="Verbose mode.")
-def grab(src, out_dir, recursive=False, zoom_level=None, no_images=False, verbose=False):
+def grab(srcs, out_dir, batch=None, catalog_path=None, recursive=False, depth=None, zoom_levels=(), no_images=False, tile_workers=None,
+         metadata_workers=METADATA_WORKERS, image_workers=MAX_WORKERS, writer_workers=WRITER_WORKERS,
+         max_rate=None, max_bandwidth=None, processes=None,
+         region=None, mirror=False, stream=False, cache_dir=None, cache_size=2048, no_cache=False,
+         metadata_cache_dir=None, metadata_ttl=grabs.cache.RESPONSE_TTL, no_metadata_cache=False, offline=False,
+         repair_retries=grabs.untiler.REPAIR_RETRIES, resume=False, show_stats=False, stats_file=None, root_url=grabs.transport.BS_ROOT,
+         verbose=False):
     log_level = logging.DEBUG if verbose else logging.INFO
     log.setLevel(log_level)
 
+    if not srcs and not batch:
+        raise click.UsageError('Set the URL of a document with --src, or a file of URLs with --batch.')
+
+    zoom_levels = sorted(set(zoom_levels), reverse=True)
     path_out = Path(out_dir)
     path_out.mkdir(parents=True, exist_ok=True)
 
     # URL contains an ark finishing with something like v0008 ? That's an image. Otherwise consider it to be a document
     regex = re.compile('ark:.+/v\d+')
 
-    pool = []
+    grabs.untiler.set_decode_processes(processes)
+    grabs.cache.set_default_cache(grabs.TileCache(cache_dir or grabs.cache.CACHE_DIR, cache_size * 1024 ** 2))
 
-    if regex.search(src):
-        im = grabs.tiled_image(src)
-        log.info(f'Found tiled image at {im.viewer_url}')
-        log.debug(f'Detail: {im}')
-        serialized = serialize_json(im)
-        pool.append((im, serialized))
-    else:
-        doc = grabs.document(src)
-        log.info(f'Found document at {doc.url} with {len(doc.children_urls)} children documents')
-        serialized = serialize_json(doc)
-        pool.append((doc, serialized))
-        if recursive:
-            for sub in doc.children:
-                log.debug(f'Found child document {sub.url} with {len(sub.images)} images')
-                serialized = serialize_json(sub)
-                pool.append((sub, serialized))
-
-    n_img =0
-    n_img_failed = 0
-    # Grab documents and attached images
-    for idx, e in enumerate(pool):
-        element, mdata = e
-        log.info(f'Grabbing document {element.id} ({idx+1}/{len(pool)})')
-
-        md_file_name = element.ark or src
-        path = make_path(path_out, md_file_name)
-        with open(path, 'w') as md_file:
-            md_file.write(serialized)
-            log.debug(f'Metadata saved to {path}')
-
-        if not no_images:
-            if isinstance(element, grabs.resource.TiledImage):
-                images = [element]
-            elif isinstance(element, grabs.resource.Document):
-                images = element.images
-            log.debug(f'Found {len(images)} image(s) to download')
-            n_img += len(images)
-            with cf.ThreadPoolExecutor(MAX_WORKERS) as executor:
-                futures = [executor.submit(get_save_image, path_out, im, zoom_level or im.max_zoom) for im in images]
-                finished, unfinished = cf.wait(futures, timeout=FETCH_TIMEOUT, return_when=cf.ALL_COMPLETED)
-                for unf in unfinished:
-                    try:
-                        unf.result()
-                    except ValueError as e:
-                        log.error(f'ERROR: The download of an image failed. Caused by: \n {e}')
-                        n_img_failed += 1
-    print_end_message(out_dir, len(pool), n_img, n_img - n_img_failed)
+    # One pool of connections shared by all the images and tiles downloaded at once
+    transport = grabs.Transport(root=root_url, pool_size=image_workers * (tile_workers or grabs.untiler.TILE_WORKERS),
+                                max_rps=max_rate, max_bps=max_bandwidth and max_bandwidth * 1024,
+                                response_cache=response_cache(metadata_cache_dir, metadata_ttl, no_metadata_cache, offline),
+                                offline=offline)
+
+    # The journal records the documents and images saved, so that an interrupted job can be resumed
+    if resume and no_cache:
+        log.warning('With --no-cache, the images left unfinished by the interrupted job are downloaded again from their first tile.')
+    journal = grabs.journal.Journal(path_out / grabs.journal.JOURNAL_FILE_NAME, resume=resume)
+
+    catalog = grabs.catalog.open_catalog(catalog_path) if catalog_path else None
+
+    # The documents and images grabbed with a region are journaled apart from the whole ones
+    def journal_key(url):
+        return grabs.crawler.Crawler.key(url) + region_suffix(region)
+
+    def completed(url):
+        record = journal.get('document', journal_key(url))
+        if record and (record['with_images'] or no_images):
+            return record['children_urls']
+
+    stats = Counter()
+    stats_lock = threading.Lock()
+
+    def count(**counts):
+        with stats_lock:
+            stats.update(counts)
+            return stats
+
+    # The documents and images of each source are resolved while the images found before are downloaded
+    def resolve(src):
+        if completed(src) is not None and not recursive:
+            log.info(f'{src} was already grabbed')
+            return
+        if regex.search(src):
+            im = grabs.tiled_image(src, transport=transport)
+            log.info(f'Found tiled image at {im.viewer_url}')
+            log.debug(f'Detail: {im}')
+            elements = [im]
+        elif recursive:
+            # The documents are grabbed while the crawler keeps walking the tree of sub-documents
+            elements = grabs.crawler.Crawler(transport, max_depth=depth, completed=completed).crawl(src)
+        else:
+            elements = [grabs.document(src, transport=transport)]
+
+        for idx, element in enumerate(elements):
+            n_docs = count(docs=1)['docs']
+            if isinstance(element, grabs.resource.Document):
+                found = f'Found document at {element.url} with {len(element.children_urls)} children documents'
+                if idx:
+                    log.debug(found)
+                else:
+                    log.info(found)
+            log.info(f'Grabbing document {element.id} ({n_docs})')
+
+            if not catalog:
+                save_metadata(path_out, element, src)
+
+            pending = []
+            if not no_images:
+                if isinstance(element, grabs.resource.TiledImage):
+                    images = [element]
+                elif isinstance(element, grabs.resource.Document):
+                    images = element.images
+                log.debug(f'Found {len(images)} image(s) to download')
+                count(images=len(images))
+                pending = [im for im in images if not saved(im)]
+                if len(pending) < len(images):
+                    log.info(f'Skipping {len(images) - len(pending)} image(s) already saved')
+
+            job = DocumentJob(journal_key(getattr(element, 'url', src)), element, journal,
+                              len(pending) + (1 if catalog else 0), with_images=not no_images)
+            if catalog:
+                # The records are written by batches, the document is journaled once its batch is written
+                catalog.add(element, callback=job.done)
+            for im in pending:
+                yield job, im
+
+    def saved(im):
+        try:
+            if mirror:
+                paths = mirror_paths(path_out, im, zoom_levels, region).values()
+            else:
+                paths = image_paths(path_out, im, zoom_levels or [im.max_zoom], stream, region).values()
+        except ValueError:
+            return False # The region is out of the image, the error is reported when it is untiled
+        return all(journal.get('image', journal_path(path_out, path)) for path in paths)
+
+    def untile(job_image):
+        job, im = job_image
+        try:
+            if mirror:
+                untiled = mirror_image(path_out, im, zoom_levels or None, tile_workers, not no_cache, repair_retries, region)
+            else:
+                untiled = untile_image(path_out, im, zoom_levels or [im.max_zoom], tile_workers, stream, not no_cache,
+                                       repair_retries, region)
+        except (ValueError, OSError, requests.exceptions.RequestException) as e:
+            log.error(f'ERROR: The download of an image failed. Caused by: \n {e}')
+            count(images_failed=1)
+            job.done(complete=False)
+            return []
+        return [(job, im, untiled)]
+
+    def save(job_image_untiled):
+        job, im, untiled = job_image_untiled
+        try:
+            save_image(im, untiled, stream or mirror)
+        except (ValueError, OSError) as e:
+            log.error(f'ERROR: The image {im.file_name} could not be saved. Caused by: \n {e}')
+            count(images_failed=1)
+            job.done(complete=False)
+            return
+        for im_path, result in untiled:
+            if result.success_rate == 1:
+                journal.add('image', journal_path(path_out, im_path))
+        job.done(complete=all(result.success_rate == 1 for _, result in untiled))
+
+    def on_error(stage, item, err):
+        if isinstance(item, str):
+            log.error(f'ERROR: Unable to grab {item}. Caused by: \n {err}')
+            return
+        # An image that failed in an unexpected way is not saved, its document is not journaled
+        job, im = item[:2]
+        log.error(f'ERROR: Unable to grab {im.file_name}. Caused by: \n {err}')
+        count(images_failed=1)
+        job.done(complete=False)
+
+    # Each stage has its own workers, and the queues between the stages are bounded so that
+    # the untiled images waiting to be saved do not pile up in memory
+    pipeline = grabs.pipeline.Pipeline(on_error=on_error)
+    pipeline.add_stage('resolve', resolve, metadata_workers)
+    pipeline.add_stage('untile', untile, image_workers, queue_size=2 * image_workers)
+    pipeline.add_stage('save', save, writer_workers, queue_size=writer_workers)
+    sources = itertools.chain(srcs, read_sources(batch) if batch else [])
+    collector = collect_stats(show_stats, stats_file)
+    try:
+        pipeline.run(sources)
+    finally:
+        if catalog:
+            catalog.close()
+        journal.close()
+        report_stats(collector, show_stats, stats_file)
+    print_end_message(out_dir, stats['docs'], stats['images'], stats['images'] - stats['images_failed'])
+
+
+@click.group()
+def queue():
+    """Grab documents with several workers sharing a queue of jobs, in a SQLite file.
+
+    Seed the queue once with `grabs-queue seed`, then start `grabs-queue work` as many times as needed,
+    on one or several hosts sharing the queue file and the output directory.
+    """
+
+
+@queue.command()
+@click.option("--queue", "-q", "queue_path", required=True, type=click.Path(dir_okay=False),
+              help="Path to the SQLite file of the queue, created if it does not exist.")
+@click.option("--src", "-s", "srcs", multiple=True,
+              help="The URL of a document or an image to retrieve. Repeat it to retrieve several documents.")
+@click.option("--batch", "-b", default=None, type=click.File('r'),
+              help="A file listing the URLs of the documents to retrieve, '-' to read them from the standard input.")
+@click.option("--recursive", "-r", is_flag=True, default=False,
+              help="Download the sub-documents of the documents.")
+@click.option("--depth", "-d", default=None, type=int,
+              help="With -r, the number of levels of sub-documents to download.")
+@click.option("--root-url", default=grabs.transport.BS_ROOT, show_default=True,
+              help="The root URL of the library, e.g. to grab from a local test server.")
+@click.option("--verbose", "-v", is_flag=True, default=False,
+              help="Verbose mode.")
+def seed(queue_path, srcs, batch=None, recursive=False, depth=None, root_url=grabs.transport.BS_ROOT, verbose=False):
+    """Put the documents and images to grab in the queue."""
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
+    if not srcs and not batch:
+        raise click.UsageError('Set the URL of a document with --src, or a file of URLs with --batch.')
+    regex = re.compile('ark:.+/v\d+')
+    transport = grabs.Transport(root=root_url, response_cache=response_cache())
+    max_depth = depth if recursive else 0
+
+    with grabs.workqueue.WorkQueue(queue_path) as work_queue:
+        for src in itertools.chain(srcs, read_sources(batch) if batch else []):
+            if regex.search(src):
+                im = grabs.tiled_image(src, transport=transport)
+                work_queue.put([image_job(im)])
+                continue
+            # The root documents are built here, so that the workers start with all their children
+            doc = grabs.resource.DocumentBuilder(src, transport=transport).build()
+            jobs = [document_job(doc.url, 0, max_depth)]
+            if max_depth is None or max_depth > 0:
+                jobs += [document_job(url, 1, max_depth) for url in doc.children_urls]
+            work_queue.put(jobs)
+            log.info(f'Queued {len(jobs)} document(s) from {doc.url}')
+        log.info(f'Jobs in the queue: {work_queue.counts()}')
+
+
+def document_job(url, depth, max_depth):
+    return 'document', grabs.crawler.Crawler.key(url), {'url': url, 'depth': depth, 'max_depth': max_depth}
+
+
+def image_job(im):
+    return 'image', im.ark or im.manifest_url, grabs.catalog.as_dict(im)
+
+
+@queue.command()
+@click.option("--queue", "-q", "queue_path", required=True, type=click.Path(exists=True, dir_okay=False),
+              help="Path to the SQLite file of the queue.")
+@click.option("--out-dir", "-o", default=".",
+              help="Path to a directory where the documents data will be stored. Default in the current folder.")
+@click.option("--workers", "-w", default=grabs.workqueue.QUEUE_WORKERS, type=int, show_default=True,
+              help="The number of jobs run at once by this worker.")
+@click.option("--zoom-level", "-z", "zoom_levels", multiple=True, type=int,
+              help="The zoom level at which the images will be downloaded. Repeat it to save several zoom levels.")
+@click.option("--no-images", "-x", is_flag=True, default=False,
+              help="If set, only the metadata of images will be downloaded.")
+@click.option("--tile-workers", "-t", default=None, type=int,
+              help="The number of tiles downloaded at once for each image. Default to 8.")
+@click.option("--max-rate", default=None, type=float,
+              help="The maximum number of requests per second sent to the server. "
+              + "The number of requests sent at once is adapted to the errors and latency of the server anyway.")
+@click.option("--max-bandwidth", default=None, type=int,
+              help="The maximum number of KiB per second downloaded from the server.")
+@click.option("--processes", "-p", default=None, type=int,
+              help="Decode the tiles in this number of processes.")
+@click.option("--region", default=None, callback=parse_region,
+              help="Only grab the area x0,y0,x1,y1 of the images, in pixels at the highest zoom level grabbed, "
+              + "or in fractions of their width and height if any value has decimals, e.g. 0.5,0.5,1,1.")
+@click.option("--mirror", is_flag=True, default=False,
+              help="Save the original tiles of the images as they are, with a DeepZoom .dzi file.")
+@click.option("--stream", is_flag=True, default=False,
+              help="Write the images to uncompressed TIFF files row of tiles by row of tiles.")
+@click.option("--cache-dir", default=None, type=click.Path(file_okay=False),
+              help="Path to a directory where the downloaded tiles are cached.")
+@click.option("--cache-size", default=2048, type=int, show_default=True,
+              help="The maximum size of the tiles cache, in MiB. The least recently used tiles are removed first.")
+@click.option("--no-cache", is_flag=True, default=False,
+              help="Do not read or save the tiles in the cache.")
+@click.option("--metadata-cache-dir", default=None, type=click.Path(file_okay=False),
+              help="Path to a directory where the pages, manifests and lists of sub-documents are cached. "
+              + "Default to grabs/responses in the user cache directory.")
+@click.option("--metadata-ttl", default=grabs.cache.RESPONSE_TTL, type=int, show_default=True,
+              help="In seconds, how long the cached metadata are used without asking the server. "
+              + "After that, they are only downloaded again if the server tells they changed.")
+@click.option("--no-metadata-cache", is_flag=True, default=False,
+              help="Do not read or save the metadata in the cache.")
+@click.option("--offline", is_flag=True, default=False,
+              help="Do not send any request, only use the metadata and tiles in the caches.")
+@click.option("--repair-retries", default=grabs.untiler.REPAIR_RETRIES, type=int, show_default=True,
+              help="How many times the tiles that could not be downloaded are fetched again, "
+              + "before the job of the image fails and is tried again later.")
+@click.option("--lease", default=grabs.workqueue.LEASE_DURATION, type=int, show_default=True,
+              help="In seconds, how long the jobs of a worker that stopped answering wait before they are given "
+              + "to another worker.")
+@click.option("--stats", "show_stats", is_flag=True, default=False,
+              help="Print a summary of the requests, tiles and time spent in each step at the end.")
+@click.option("--stats-file", default=None, type=click.Path(dir_okay=False),
+              help="Write the metrics of the run to this file, as JSON if it ends with .json, "
+              + "in the Prometheus text format otherwise (e.g. grabs.prom for the textfile collector).")
+@click.option("--root-url", default=grabs.transport.BS_ROOT, show_default=True,
+              help="The root URL of the library, e.g. to grab from a local test server.")
+@click.option("--verbose", "-v", is_flag=True, default=False,
+              help="Verbose mode.")
+def work(queue_path, out_dir, workers=grabs.workqueue.QUEUE_WORKERS, zoom_levels=(), no_images=False, tile_workers=None,
+         max_rate=None, max_bandwidth=None, processes=None, region=None, mirror=False, stream=False, cache_dir=None,
+         cache_size=2048, no_cache=False, metadata_cache_dir=None, metadata_ttl=grabs.cache.RESPONSE_TTL,
+         no_metadata_cache=False, offline=False, repair_retries=grabs.untiler.REPAIR_RETRIES,
+         lease=grabs.workqueue.LEASE_DURATION, show_stats=False, stats_file=None, root_url=grabs.transport.BS_ROOT,
+         verbose=False):
+    """Run the jobs of the queue until it is empty."""
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
+    zoom_levels = sorted(set(zoom_levels), reverse=True)
+    path_out = Path(out_dir)
+    path_out.mkdir(parents=True, exist_ok=True)
+
+    grabs.untiler.set_decode_processes(processes)
+    grabs.cache.set_default_cache(grabs.TileCache(cache_dir or grabs.cache.CACHE_DIR, cache_size * 1024 ** 2))
+    transport = grabs.Transport(root=root_url, pool_size=workers * (tile_workers or grabs.untiler.TILE_WORKERS),
+                                max_rps=max_rate, max_bps=max_bandwidth and max_bandwidth * 1024,
+                                response_cache=response_cache(metadata_cache_dir, metadata_ttl, no_metadata_cache, offline),
+                                offline=offline)
+
+    # A document job saves the metadata of the document and queues its images and children,
+    # an image job saves the image. Images with missing tiles fail, and are tried again later.
+    def handle(job):
+        if job.kind == 'document':
+            doc = grabs.resource.DocumentBuilder(job.payload['url'], transport=transport).build()
+            save_metadata(path_out, doc, job.payload['url'])
+            new_jobs = [] if no_images else [image_job(im) for im in doc.images]
+            depth, max_depth = job.payload['depth'], job.payload['max_depth']
+            if max_depth is None or depth < max_depth:
+                new_jobs += [document_job(url, depth + 1, max_depth) for url in doc.children_urls]
+            return new_jobs
+
+        im = grabs.resource.TiledImage(**job.payload, transport=transport)
+        if mirror:
+            untiled = mirror_image(path_out, im, zoom_levels or None, tile_workers, not no_cache, repair_retries, region)
+        else:
+            untiled = untile_image(path_out, im, zoom_levels or [im.max_zoom], tile_workers, stream, not no_cache,
+                                   repair_retries, region)
+            save_image(im, untiled, stream)
+        missing = [path for path, result in untiled if result.success_rate < 1]
+        if missing:
+            raise ValueError(f'Tiles are missing in {", ".join(missing)}')
+        return []
+
+    collector = collect_stats(show_stats, stats_file)
+    with grabs.workqueue.WorkQueue(queue_path, lease_duration=lease) as work_queue:
+        worker = grabs.workqueue.QueueWorker(work_queue, handle, workers)
+        log.info(f'Worker {worker.name} started')
+        try:
+            worker.run()
+        finally:
+            report_stats(collector, show_stats, stats_file)
+        log.info(f'Jobs in the queue: {work_queue.counts()}')
 
 
 if __name__ == '__main__':
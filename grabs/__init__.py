@@ -1,9 +1,23 @@
-from . import resource
+from . import (resource, crawler, journal, pipeline, catalog, workqueue, metrics)
+from .transport import (Transport, OfflineError)
+from .cache import (TileCache, ResponseCache)
 
 
-def document(url):
-    return resource.DocumentBuilder(url).build()
+def document(url, transport=None):
+    return resource.DocumentBuilder(url, transport).build()
 
 
-def tiled_image(viewer_url = None, manifest_url = None, tiles_url = None):
-    return resource.TiledImageBuilder(viewer_url, manifest_url, tiles_url).build()
+def tiled_image(viewer_url = None, manifest_url = None, tiles_url = None, transport = None):
+    return resource.TiledImageBuilder(viewer_url, manifest_url, tiles_url, transport).build()
+
+
+async def adocument(url, transport=None):
+    return await resource.AsyncDocumentBuilder(url, transport).build()
+
+
+async def atiled_image(viewer_url = None, manifest_url = None, tiles_url = None, transport = None):
+    return await resource.AsyncTiledImageBuilder(viewer_url, manifest_url, tiles_url, transport).build()
+
+
+def crawl(url, max_depth=None, transport=None):
+    return crawler.Crawler(transport, max_depth).crawl(url)
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import logging as log
+from dataclasses import dataclass
+from pathlib import Path
+import requests
+from requests.structures import CaseInsensitiveDict
+
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'grabs' / 'tiles'
+CACHE_MAX_SIZE = 2 * 1024 ** 3 # in bytes
+EVICTION_TARGET = 0.9 # Once full, the cache is shrunk to 90% of its maximum size
+RESPONSES_DIR = CACHE_DIR.parent / 'responses'
+RESPONSES_MAX_SIZE = 256 * 1024 ** 2 # in bytes
+RESPONSE_TTL = 3600 # in seconds, how long a cached response is used without asking the server whether it changed
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+class TileCache:
+
+    # A cache of the raw bytes of the tiles, stored in directory under the hash of
+    # their location (tiles url, zoom level, column and row).
+    # Tiles are written to a temporary file then renamed, so several processes can share a cache
+    # and never read a partial tile. Once the cache is larger than max_size bytes, the
+    # least recently used tiles are removed.
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_MAX_SIZE):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.__size = None # Measured on the first write
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(tiles_url, zoom_level, col, row):
+        return hashlib.sha256(f'{tiles_url}/{zoom_level}/{col}_{row}'.encode()).hexdigest()
+
+    def path(self, key):
+        return self.directory / key[:2] / key
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path) # The modification time tells when the tile was last used
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            Path(tmp_path).unlink()
+            raise
+
+        with self.__lock:
+            if self.__size is None:
+                self.__size = sum(size for _, size, _ in self.__entries())
+            else:
+                self.__size += len(data)
+            if self.__size > self.max_size:
+                self.__evict()
+
+    def __contains__(self, key):
+        return self.path(key).exists()
+
+    def clear(self):
+        with self.__lock:
+            for _, _, path in self.__entries():
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            self.__size = 0
+
+    def __entries(self):
+        if not self.directory.exists():
+            return
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.startswith('.tmp-'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError: # Removed by another process
+                    continue
+                yield stat.st_mtime, stat.st_size, Path(entry.path)
+
+    def __evict(self):
+        # Other processes may be writing to the same cache, so its size is measured again from the files.
+        entries = sorted(self.__entries())
+        size = sum(size for _, size, _ in entries)
+        target = self.max_size * EVICTION_TARGET
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        log.debug(f'Tile cache {self.directory} shrunk to {size} bytes')
+        self.__size = size
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    url: str
+    stored_at: float # in seconds since the epoch, when the response was received or last revalidated
+    headers: dict
+    encoding: str
+    content: bytes
+
+    def is_fresh(self, ttl):
+        return time.time() - self.stored_at < ttl
+
+    def validators(self):
+        # The headers of a conditional request, to which the server answers 304 Not Modified if the response didn't change
+        validators = {}
+        if self.headers.get('ETag'):
+            validators['If-None-Match'] = self.headers['ETag']
+        if self.headers.get('Last-Modified'):
+            validators['If-Modified-Since'] = self.headers['Last-Modified']
+        return validators
+
+    def response(self):
+        r = requests.Response()
+        r.url = self.url
+        r.status_code = 200
+        r.reason = 'OK'
+        r.headers = CaseInsensitiveDict(self.headers)
+        r.encoding = self.encoding
+        r._content = self.content
+        return r
+
+
+class ResponseCache:
+
+    # A cache of the responses to the requests of metadata (pages, manifests and lists of children),
+    # stored under the hash of their url. A response is used as is for ttl seconds, then it is revalidated
+    # with the server if it has an ETag or a Last-Modified header, or fetched again otherwise.
+    # The entries are stored like tiles (see TileCache), so several processes can share the cache.
+    def __init__(self, directory=RESPONSES_DIR, ttl=RESPONSE_TTL, max_size=RESPONSES_MAX_SIZE):
+        self.ttl = ttl
+        self.store = TileCache(directory, max_size)
+
+    @property
+    def directory(self):
+        return self.store.directory
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def get(self, url):
+        data = self.store.get(ResponseCache.key(url))
+        if data is None:
+            return None
+        header, _, content = data.partition(b'\n')
+        try:
+            entry = json.loads(header)
+        except ValueError: # Written by an incompatible version
+            return None
+        return CachedResponse(url, entry['stored_at'], entry['headers'], entry['encoding'], content)
+
+    def put(self, url, response):
+        headers = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+        entry = CachedResponse(url, time.time(), headers, response.encoding, response.content)
+        self.__write(entry)
+        return entry
+
+    def refresh(self, entry, response):
+        # The server answered 304 Not Modified: the cached response is fresh again, with the new validators if any
+        headers = dict(entry.headers)
+        headers.update({name: response.headers[name] for name in CACHED_HEADERS[1:] if name in response.headers})
+        entry = CachedResponse(entry.url, time.time(), headers, entry.encoding, entry.content)
+        self.__write(entry)
+        return entry
+
+    def __write(self, entry):
+        header = json.dumps({'stored_at': entry.stored_at, 'headers': entry.headers, 'encoding': entry.encoding})
+        self.store.put(ResponseCache.key(entry.url), header.encode() + b'\n' + entry.content)
+
+    def __contains__(self, url):
+        return ResponseCache.key(url) in self.store
+
+    def clear(self):
+        self.store.clear()
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = TileCache()
+        return _default_cache
+
+
+def set_default_cache(cache):
+    global _default_cache
+    with _default_lock:
+        _default_cache = cache
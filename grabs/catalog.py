@@ -0,0 +1,205 @@
+import os
+import json
+import sqlite3
+import threading
+import dataclasses
+import logging as log
+from pathlib import Path
+from .resource import (Document, TiledImage)
+
+CATALOG_BATCH_SIZE = 500 # Number of records written at once
+NON_SERIALIZED_FIELDS = ('transport',)
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+NDJSON_SUFFIXES = ('.ndjson', '.jsonl')
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    url TEXT PRIMARY KEY,
+    ark TEXT,
+    iid TEXT,
+    category TEXT,
+    parent_iid TEXT,
+    properties_lang TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_ark ON documents (ark);
+CREATE INDEX IF NOT EXISTS documents_iid ON documents (iid);
+CREATE INDEX IF NOT EXISTS documents_parent_iid ON documents (parent_iid);
+CREATE INDEX IF NOT EXISTS documents_category ON documents (category);
+
+CREATE TABLE IF NOT EXISTS images (
+    manifest_url TEXT PRIMARY KEY,
+    ark TEXT,
+    iid TEXT,
+    document_url TEXT,
+    file_name TEXT,
+    width INTEGER,
+    height INTEGER,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_ark ON images (ark);
+CREATE INDEX IF NOT EXISTS images_iid ON images (iid);
+CREATE INDEX IF NOT EXISTS images_document_url ON images (document_url);
+
+CREATE TABLE IF NOT EXISTS properties (
+    document_url TEXT NOT NULL,
+    property TEXT NOT NULL,
+    name TEXT,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS properties_document_url ON properties (document_url);
+CREATE INDEX IF NOT EXISTS properties_property_value ON properties (property, value);
+'''
+
+
+def as_dict(instance):
+    # The fields of a document or an image, without the fields that are not metadata
+    def dict_factory(items):
+        return {k: v for k, v in items if k not in NON_SERIALIZED_FIELDS}
+    return dataclasses.asdict(instance, dict_factory=dict_factory)
+
+
+def check_element(element):
+    if not isinstance(element, (Document, TiledImage)):
+        raise ValueError(f"Cannot add {type(element).__name__} to a catalog, expected a Document or a TiledImage.")
+
+
+def open_catalog(path, batch_size=CATALOG_BATCH_SIZE):
+    # The kind of catalog is chosen from the extension of path
+    suffix = Path(path).suffix.lower()
+    if suffix in SQLITE_SUFFIXES:
+        return SqliteCatalog(path, batch_size)
+    if suffix in NDJSON_SUFFIXES:
+        return NdjsonCatalog(path, batch_size)
+    raise ValueError(f"Unknown kind of catalog {path}, expected one of {list(SQLITE_SUFFIXES + NDJSON_SUFFIXES)}.")
+
+
+class SqliteCatalog:
+
+    # Stores the documents and images in a SQLite database, with one row per document, image
+    # and value of a property, e.g. to find the documents having a property:
+    #   SELECT d.url FROM documents d JOIN properties p ON p.document_url = d.url WHERE p.property = 'date'
+    # The full record of each document or image is kept as JSON in the record column.
+    # A document or an image added again replaces the previous one.
+    # Records are written batch_size at a time in one transaction, the last ones on flush() or close().
+    # If set, callback() is called once the record is written.
+    def __init__(self, path, batch_size=CATALOG_BATCH_SIZE):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.pending = []
+        self.__lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL') # Readers do not block the writes of a running job
+        self.connection.executescript(SQLITE_SCHEMA)
+
+    def add(self, element, callback=None):
+        # The rows are made at once, so that the batch does not keep the elements themselves
+        check_element(element)
+        if isinstance(element, Document):
+            rows = ([SqliteCatalog.__document_row(element)],
+                    [SqliteCatalog.__image_row(im, element.url) for im in element.images],
+                    [(element.url, prop, entry.get('name'), value)
+                     for prop, entry in element.properties.items() for value in entry.get('values', [])])
+        else:
+            rows = ([], [SqliteCatalog.__image_row(element, element.parent_url)], [])
+        with self.__lock:
+            self.pending.append((rows, callback))
+            if len(self.pending) >= self.batch_size:
+                self.__write()
+
+    def flush(self):
+        with self.__lock:
+            self.__write()
+
+    def __write(self):
+        if not self.pending:
+            return
+        documents, images, properties = [], [], []
+        for (document_rows, image_rows, property_rows), _ in self.pending:
+            documents.extend(document_rows)
+            images.extend(image_rows)
+            properties.extend(property_rows)
+
+        with self.connection:
+            self.connection.executemany('DELETE FROM properties WHERE document_url = ?', [(row[0],) for row in documents])
+            self.connection.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)', documents)
+            self.connection.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)', images)
+            self.connection.executemany('INSERT INTO properties VALUES (?, ?, ?, ?)', properties)
+        log.debug(f'{len(self.pending)} record(s) written to the catalog {self.path}')
+        written, self.pending = self.pending, []
+        for _, callback in written:
+            if callback:
+                callback()
+
+    @staticmethod
+    def __document_row(doc):
+        return (doc.url, doc.ark, doc.iid, doc.category, doc.parent_iid, doc.properties_lang,
+                json.dumps(as_dict(doc), ensure_ascii=False))
+
+    @staticmethod
+    def __image_row(im, document_url):
+        return (im.manifest_url, im.ark, im.iid, document_url, im.file_name, im.width, im.height,
+                json.dumps(as_dict(im), ensure_ascii=False))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NdjsonCatalog:
+
+    # Appends the documents and images to a file, one JSON record per line with its kind
+    # ("document" or "image") in the "type" field. A document or an image added again is appended again,
+    # the last record wins. Records are written batch_size at a time, the last ones on flush() or close().
+    # If set, callback() is called once the record is written.
+    def __init__(self, path, batch_size=CATALOG_BATCH_SIZE):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.pending = []
+        self.__lock = threading.Lock()
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def add(self, element, callback=None):
+        check_element(element)
+        record = dict(as_dict(element), type='document' if isinstance(element, Document) else 'image')
+        line = json.dumps(record, ensure_ascii=False)
+        with self.__lock:
+            self.pending.append((line, callback))
+            if len(self.pending) >= self.batch_size:
+                self.__write()
+
+    def flush(self):
+        with self.__lock:
+            self.__write()
+
+    def __write(self):
+        if not self.pending:
+            return
+        self.file.write(''.join(line + '\n' for line, _ in self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        log.debug(f'{len(self.pending)} record(s) written to the catalog {self.path}')
+        written, self.pending = self.pending, []
+        for _, callback in written:
+            if callback:
+                callback()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,79 @@
+import re
+import requests
+import concurrent.futures as cf
+import logging as log
+from collections import deque
+from .resource import DocumentBuilder
+from .transport import default_transport
+
+CRAWL_WORKERS = 8 # Number of documents built at once
+
+
+class Crawler:
+
+    # Walks a tree of documents breadth first, from a root document down to max_depth levels
+    # of children (the whole tree if max_depth is None). The documents are built by a pool of
+    # workers and yielded as soon as they are built, so not exactly in breadth-first order.
+    # Each ark is visited once, even if several documents of the tree link to it.
+    # Documents that cannot be built are logged and skipped, their urls are kept in failed_urls.
+    # If set, completed(url) returns the children urls of a document handled by a previous crawl,
+    # or None. Such documents are neither built nor yielded, but their children are crawled.
+    def __init__(self, transport=None, max_depth=None, workers=CRAWL_WORKERS, completed=None):
+        self.transport = transport or default_transport()
+        self.max_depth = max_depth
+        self.workers = workers
+        self.completed = completed
+        self.failed_urls = []
+
+    def crawl(self, url):
+        seen = {Crawler.key(url)}
+        frontier = deque([(url, 0)])
+        running = {}
+
+        def expand(children_urls, depth):
+            if self.max_depth is None or depth < self.max_depth:
+                for child_url in children_urls:
+                    key = Crawler.key(child_url)
+                    if key not in seen:
+                        seen.add(key)
+                        frontier.append((child_url, depth + 1))
+
+        # Only a few documents are built ahead of the consumer, the others wait in the frontier
+        with cf.ThreadPoolExecutor(self.workers) as executor:
+            try:
+                while frontier or running:
+                    while frontier and len(running) < 2 * self.workers:
+                        doc_url, depth = frontier.popleft()
+                        children_urls = self.completed(doc_url) if self.completed else None
+                        if children_urls is not None:
+                            expand(children_urls, depth)
+                            continue
+                        running[executor.submit(self.__build, doc_url)] = (doc_url, depth)
+
+                    if not running:
+                        continue
+
+                    done, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+                    for future in done:
+                        doc_url, depth = running.pop(future)
+                        try:
+                            doc = future.result()
+                        except (requests.exceptions.RequestException, ValueError) as err:
+                            log.error(f'Error: Unable to build the document {doc_url}.\n' \
+                                      f'Caused by {err}')
+                            self.failed_urls.append(doc_url)
+                            continue
+
+                        expand(doc.children_urls, depth)
+                        yield doc
+            finally:
+                for future in running:
+                    future.cancel()
+
+    def __build(self, url):
+        return DocumentBuilder(url, transport=self.transport).build()
+
+    @staticmethod
+    def key(url):
+        m = re.search(r'ark:\/[^\?]+\/[^\?]+', url)
+        return m.group(0) if m else url
@@ -0,0 +1,77 @@
+import os
+import json
+import threading
+import logging as log
+from pathlib import Path
+
+JOURNAL_FILE_NAME = '.grabs-journal.jsonl'
+
+
+class Journal:
+
+    # An append-only log of the work done by a job, one JSON record per line.
+    # Each record is flushed to disk before add() returns, so after a crash the journal
+    # lists everything that was completed. A line cut by a crash is ignored on load.
+    # If resume is False, the records of the previous job are discarded.
+    # Only the position of each record in the file is kept in memory, get() reads the record
+    # from the file, so that the journal of a large job does not fill the memory.
+    def __init__(self, path, resume=False):
+        self.path = Path(path)
+        self.offsets = {}
+        self.__lock = threading.Lock()
+        if resume and self.path.exists():
+            self.__load()
+        self.file = open(self.path, 'ab' if resume else 'wb')
+        if resume and self.file.tell() and not self.__ends_with_newline():
+            self.file.write(b'\n') # Do not append the next record to a line cut by a crash
+        self.reader = open(self.path, 'rb')
+
+    def __load(self):
+        with open(self.path, 'rb') as journal:
+            offset = 0
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    log.warning(f'Ignoring an incomplete record of the journal {self.path}')
+                else:
+                    self.offsets[record['kind'], record['key']] = offset
+                offset += len(line)
+        log.debug(f'{len(self.offsets)} records loaded from the journal {self.path}')
+
+    def __ends_with_newline(self):
+        with open(self.path, 'rb') as journal:
+            journal.seek(-1, os.SEEK_END)
+            return journal.read(1) == b'\n'
+
+    def add(self, kind, key, **fields):
+        record = dict(fields, kind=kind, key=key)
+        line = json.dumps(record, ensure_ascii=False).encode('utf-8')
+        with self.__lock:
+            offset = self.file.tell()
+            self.file.write(line + b'\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.offsets[kind, key] = offset
+
+    def get(self, kind, key):
+        with self.__lock:
+            offset = self.offsets.get((kind, key))
+            if offset is None:
+                return None
+            self.reader.seek(offset)
+            line = self.reader.readline()
+        return json.loads(line)
+
+    def __contains__(self, kind_key):
+        return kind_key in self.offsets
+
+    def close(self):
+        self.file.close()
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
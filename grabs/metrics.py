@@ -0,0 +1,190 @@
+import json
+import math
+import time
+import threading
+import logging as log
+from collections import Counter
+from contextlib import contextmanager
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300) # in seconds
+AGGREGATED_LABELS = ('image',) # Labels with one value per image, dropped by Metrics to keep the number of series small
+PROMETHEUS_PREFIX = 'grabs_'
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+_collectors = []
+_lock = threading.Lock()
+
+
+# A collector is called as collector(kind, name, value, labels) for each value emitted by grabs, where kind is
+# COUNTER (value is added to the metric) or HISTOGRAM (value is one observation, e.g. the duration of a request).
+# Collectors are called in the threads doing the work, so they must be thread-safe and fast.
+def add_collector(collector):
+    global _collectors
+    with _lock:
+        _collectors = _collectors + [collector] # Copied, so that emitting never takes the lock
+
+
+def remove_collector(collector):
+    global _collectors
+    with _lock:
+        _collectors = [c for c in _collectors if c is not collector]
+
+
+def count(name, value=1, **labels):
+    for collector in _collectors:
+        collector(COUNTER, name, value, labels)
+
+
+def observe(name, value, **labels):
+    for collector in _collectors:
+        collector(HISTOGRAM, name, value, labels)
+
+
+@contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+class Stopwatch:
+
+    # Sums the time spent in each step of a task run by several threads, e.g. fetching, decoding and pasting
+    # the tiles of an image, so that the total of each step is emitted once per task.
+    def __init__(self):
+        self.seconds = Counter()
+        self.started = time.perf_counter()
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, step):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.__lock:
+                self.seconds[step] += elapsed
+
+    def emit(self, prefix, **labels):
+        # Observes {prefix}_seconds, the time since the stopwatch was created, and {prefix}_{step}_seconds for each step
+        observe(f'{prefix}_seconds', time.perf_counter() - self.started, **labels)
+        with self.__lock:
+            steps = list(self.seconds.items())
+        for step, seconds in steps:
+            observe(f'{prefix}_{step}_seconds', seconds, **labels)
+
+
+class Metrics:
+
+    # A collector keeping the total of each counter and a histogram of the observations of each histogram,
+    # by name and labels. The labels of AGGREGATED_LABELS are dropped, e.g. the durations of all the images
+    # end up in one histogram.
+    # Use it with add_collector, or as a context manager to collect only within a block.
+    def __init__(self, buckets=DURATION_BUCKETS, aggregated_labels=AGGREGATED_LABELS):
+        self.buckets = tuple(buckets)
+        self.aggregated_labels = aggregated_labels
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.__lock = threading.Lock()
+
+    def __call__(self, kind, name, value, labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items() if k not in self.aggregated_labels)))
+        with self.__lock:
+            if kind == COUNTER:
+                self.counters[key] = self.counters.get(key, 0) + value
+                return
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'count': 0, 'sum': 0, 'max': 0, 'buckets': [0] * len(self.buckets)}
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['max'] = max(histogram['max'], value)
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][idx] += 1
+                    break
+
+    def total(self, name):
+        # The sum of a counter over all its labels
+        with self.__lock:
+            return sum(value for (n, _), value in self.counters.items() if n == name)
+
+    def quantile(self, histogram, q):
+        # Estimated from the buckets, as the upper bound of the bucket holding the q-th observation
+        rank = math.ceil(q * histogram['count'])
+        seen = 0
+        for bound, n in zip(self.buckets, histogram['buckets']):
+            seen += n
+            if seen >= rank:
+                return min(bound, histogram['max'])
+        return histogram['max']
+
+    def summary(self):
+        with self.__lock:
+            counters = dict(self.counters)
+            histograms = {key: dict(h, buckets=list(h['buckets'])) for key, h in self.histograms.items()}
+        elapsed = time.time() - self.started
+        tiles = sum(value for (name, _), value in counters.items() if name == 'tiles_total')
+        return {
+            'elapsed_seconds': elapsed,
+            'tiles_per_second': tiles / elapsed if elapsed else 0,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(counters.items())],
+            'histograms': [{'name': name, 'labels': dict(labels), 'count': h['count'], 'sum': h['sum'],
+                            'mean': h['sum'] / h['count'], 'p50': self.quantile(h, 0.5), 'p95': self.quantile(h, 0.95),
+                            'max': h['max']}
+                           for (name, labels), h in sorted(histograms.items())],
+        }
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self):
+        # In the text format read by the textfile collector of the Prometheus node exporter
+        with self.__lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(h)) for key, h in self.histograms.items())
+        lines = []
+        typed = set()
+
+        def series(name, labels, value, extra=()):
+            labels = ','.join(f'{k}="{v}"' for k, v in tuple(labels) + tuple(extra))
+            lines.append(f'{PROMETHEUS_PREFIX}{name}{{{labels}}} {value}' if labels else f'{PROMETHEUS_PREFIX}{name} {value}')
+
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name} counter')
+                typed.add(name)
+            series(name, labels, value)
+        for (name, labels), h in histograms:
+            if name not in typed:
+                lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name} histogram')
+                typed.add(name)
+            cumulated = 0
+            for bound, n in zip(self.buckets, h['buckets']):
+                cumulated += n
+                series(f'{name}_bucket', labels, cumulated, [('le', bound)])
+            series(f'{name}_bucket', labels, h['count'], [('le', '+Inf')])
+            series(f'{name}_sum', labels, h['sum'])
+            series(f'{name}_count', labels, h['count'])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # JSON if path ends with .json, the Prometheus text format otherwise (e.g. grabs.prom)
+        text = self.to_json() if str(path).endswith('.json') else self.to_prometheus()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        log.debug(f'Metrics written to {path}')
+
+    def __enter__(self):
+        add_collector(self)
+        return self
+
+    def __exit__(self, *exc):
+        remove_collector(self)
@@ -0,0 +1,86 @@
+import time
+import queue
+import threading
+import logging as log
+from . import metrics
+
+QUEUE_SIZE = 16 # Number of items waiting between two stages
+
+_END = object() # Tells the workers of a stage that no more items will come
+
+
+class Pipeline:
+
+    # Runs items through a chain of stages. Each stage is run by its own threads and passes its
+    # results to the next stage through a bounded queue, so a slow stage holds back the stages
+    # before it instead of letting their results pile up in memory.
+    # A stage is a function taking an item and returning an iterable of the items for the next stage,
+    # the items returned by the last stage are dropped. If it is a generator, its items are passed on as they come.
+    # An exception raised by a stage is passed to on_error(stage name, item, error) and the item is dropped.
+    def __init__(self, on_error=None):
+        self.stages = []
+        self.on_error = on_error
+
+    def add_stage(self, name, fn, workers=1, queue_size=QUEUE_SIZE):
+        if workers < 1:
+            raise ValueError(f"A stage needs at least 1 worker, got {workers} for stage {name}.")
+        self.stages.append((name, fn, workers, queue.Queue(queue_size)))
+        return self
+
+    def run(self, items):
+        threads = []
+        for idx, (name, fn, workers, inbox) in enumerate(self.stages):
+            _, _, next_workers, outbox = self.stages[idx + 1] if idx + 1 < len(self.stages) else (None, None, 0, None)
+            # The last worker of a stage to finish tells the next stage to stop
+            remaining = [workers]
+            lock = threading.Lock()
+            for n in range(workers):
+                thread = threading.Thread(target=self.__work, args=(name, fn, inbox, outbox, next_workers, remaining, lock),
+                                          name=f'{name}-{n}', daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        _, _, first_workers, first_inbox = self.stages[0]
+        try:
+            for item in items:
+                first_inbox.put(item)
+        finally:
+            for _ in range(first_workers):
+                first_inbox.put(_END)
+        for thread in threads:
+            thread.join()
+
+    def __work(self, name, fn, inbox, outbox, next_workers, remaining, lock):
+        try:
+            while True:
+                item = inbox.get()
+                if item is _END:
+                    break
+                # The time a stage spends on an item does not include the time it waits for the next stage
+                start = time.perf_counter()
+                blocked = 0
+                try:
+                    for result in fn(item) or ():
+                        if outbox is not None:
+                            put_start = time.perf_counter()
+                            outbox.put(result)
+                            blocked += time.perf_counter() - put_start
+                except Exception as err:
+                    # An error of on_error is logged too, so that the worker goes on with the next items
+                    try:
+                        if not self.on_error:
+                            raise
+                        self.on_error(name, item, err)
+                    except Exception:
+                        log.exception(f'Error: Stage {name} failed on {item}')
+                metrics.observe('stage_seconds', time.perf_counter() - start - blocked, stage=name)
+                if blocked:
+                    metrics.observe('stage_blocked_seconds', blocked, stage=name)
+        finally:
+            # Even if the worker stopped on an error, the next stage is told to stop once all the workers are done
+            with lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last:
+                for _ in range(next_workers):
+                    outbox.put(_END)
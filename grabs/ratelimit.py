@@ -0,0 +1,155 @@
+import time
+import threading
+import logging as log
+from urllib.parse import urlparse
+
+MIN_CONCURRENCY = 1
+DECREASE_FACTOR = 0.5 # The concurrency is halved when the server shows signs of overload
+LATENCY_TOLERANCE = 3 # The server is considered overloaded when its latency is 3 times its usual latency
+LATENCY_SMOOTHING = 0.2 # Weight of the last request in the moving average of the latency
+BASE_LATENCY_DRIFT = 0.01 # The usual latency of a server slowly rises, so that it follows lasting changes
+OVERLOAD_STATUSES = (429, 500, 502, 503, 504)
+REQUEST_CLASS_DEPTH = 2 # Number of segments of the path telling the class of a request, e.g. /ark:/73873 or /in/rest
+
+
+def request_class(url):
+    # Requests of one class take about the same time on a healthy server: the tiles (by the extension of the file),
+    # the pages of the documents and viewers, the manifests and lists of children...
+    path = urlparse(url).path
+    name = path.rsplit('/', 1)[-1]
+    if '.' in name:
+        return name.rsplit('.', 1)[-1].lower()
+    return '/'.join(path.split('/')[:REQUEST_CLASS_DEPTH + 1])
+
+
+class TokenBucket:
+
+    # Lets rate units per second through, with bursts of up to capacity units.
+    # Units can be taken beyond the capacity: the bucket is then in debt, and the next takers wait.
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def take(self, n=1, wait=True):
+        with self.__lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait and delay:
+            time.sleep(delay)
+
+
+class HostLimiter:
+
+    # Bounds the requests sent to one host: their number per second, their bytes per second, and how many
+    # run at once. The number of requests at once is adapted to the server (additive increase, multiplicative
+    # decrease): it grows by one every limit successful requests, and is halved, at most once per latency
+    # period, when a request fails, is retried, gets a 429 or 5xx response, or is much slower than usual.
+    # The usual latency is followed for each class of requests, so that a large page is not taken for
+    # a slow tile, see request_class.
+    def __init__(self, host, max_concurrency, max_rps=None, max_bps=None, min_concurrency=MIN_CONCURRENCY):
+        self.host = host
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.requests = TokenBucket(max_rps) if max_rps else None
+        self.bandwidth = TokenBucket(max_bps) if max_bps else None
+        self.latencies = {} # (moving average, usual latency) of each class of requests, in seconds
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.__condition = threading.Condition()
+
+    def acquire(self):
+        with self.__condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.__condition.wait(pause if pause > 0 else None)
+            self.in_flight += 1
+        if self.requests:
+            self.requests.take()
+        if self.bandwidth:
+            self.bandwidth.take(0) # Waits until the bytes of the previous responses are paid off
+
+    def release(self, latency, n_bytes=0, overloaded=False, retry_after=None, request_class=None):
+        if self.bandwidth and n_bytes:
+            self.bandwidth.take(n_bytes, wait=False)
+        with self.__condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            average, base_latency = self.latencies.get(request_class, (latency, latency))
+            average = (1 - LATENCY_SMOOTHING) * average + LATENCY_SMOOTHING * latency
+            base_latency = min(latency, base_latency * (1 + BASE_LATENCY_DRIFT))
+            self.latencies[request_class] = average, base_latency
+            slow = average > LATENCY_TOLERANCE * base_latency
+            if overloaded or slow:
+                if now - self.last_decrease > average:
+                    self.limit = max(self.min_concurrency, self.limit * DECREASE_FACTOR)
+                    self.last_decrease = now
+                    log.debug(f'Server {self.host} is {"overloaded" if overloaded else "slowing down"}, '
+                              f'sending up to {int(self.limit)} request(s) at once')
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            self.__condition.notify_all()
+
+
+class RateLimiter:
+
+    # The limiters of all the hosts requested through a transport, see HostLimiter.
+    def __init__(self, max_concurrency, max_rps=None, max_bps=None, min_concurrency=MIN_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.max_rps = max_rps
+        self.max_bps = max_bps
+        self.min_concurrency = min_concurrency
+        self.hosts = {}
+        self.__lock = threading.Lock()
+
+    def host(self, url):
+        host = urlparse(url).netloc
+        with self.__lock:
+            limiter = self.hosts.get(host)
+            if limiter is None:
+                limiter = self.hosts[host] = HostLimiter(host, self.max_concurrency, self.max_rps, self.max_bps,
+                                                         self.min_concurrency)
+            return limiter
+
+    def send(self, url, request):
+        # Runs request() once the host of url accepts one more request, and returns its response
+        limiter = self.host(url)
+        limiter.acquire()
+        start = time.monotonic()
+        response = None
+        try:
+            response = request()
+        finally:
+            latency = time.monotonic() - start
+            if response is None:
+                limiter.release(latency, overloaded=True, request_class=request_class(url)) # Connection error or timeout
+            else:
+                limiter.release(latency, len(response.content), RateLimiter.__overloaded(response),
+                                RateLimiter.__retry_after(response), request_class(url))
+        return response
+
+    @staticmethod
+    def __overloaded(response):
+        # The transport retries some requests by itself, their failures are kept in the history of the response
+        retries = getattr(response.raw, 'retries', None)
+        return response.status_code in OVERLOAD_STATUSES or bool(retries and retries.history)
+
+    @staticmethod
+    def __retry_after(response):
+        if response.status_code not in OVERLOAD_STATUSES:
+            return None
+        try:
+            return float(response.headers.get('Retry-After', ''))
+        except ValueError:
+            return None
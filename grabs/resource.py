@@ -1,22 +1,46 @@
-import requests
+import asyncio
+import concurrent.futures as cf
 import json
 import re
+import sys
+from collections import deque
 import math
 import traceback
-from bs4 import BeautifulSoup
+from bs4 import (BeautifulSoup, SoupStrainer)
 from urllib.parse import urlparse
 from dataclasses import (dataclass, field)
-from .untiler import Untiler
+from .untiler import (Untiler, AsyncUntiler, REPAIR_RETRIES)
+from .transport import (Transport, default_transport, BS_ROOT)
+from .cache import default_cache
+from . import metrics
 
 COLLECTION_TYPES = ['CollectionIconography']
 N_SUBDOCS_AT_ONCE = 100
 SUBDOCS_MAX_PAGES = 100
-FETCH_TIMEOUT = 20 # in seconds
+SUBDOCS_ID_FIELD = 'InterviewId'
+MANIFEST_WORKERS = 8 # Number of image manifests fetched at once for a document
+GEOQUERY_PAGES_AT_ONCE = 4 # Number of pages of children fetched at once for a document
+CHILDREN_WORKERS = 8 # Number of children documents built at once by Document.children
+
+try:
+    import lxml
+    HTML_PARSER = 'lxml' # Several times faster than the parser of the standard library
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+SCRIPT_REGEX = re.compile(r'<script[^>]*>(.*?)</script\s*>', flags=re.IGNORECASE | re.DOTALL)
+JS_VAR_REGEX = re.compile(r'var\s+(\w+)\s*=\s*(.+)', flags=re.IGNORECASE)
+# Only the properties of a document are parsed. The class is matched with a regex because
+# the strainer may see the raw class attribute, with all the classes of the element.
+PROPERTIES_STRAINER = SoupStrainer('div', {'class': re.compile(r'\bNormalField\b')})
+PROPERTIES_START_REGEX = re.compile(r'<div[^>]*\bNormalField\b', flags=re.IGNORECASE)
+# Documents and images are created by the thousands in a crawl, their fields are kept in slots where supported
+SLOTTED = {'slots': True} if sys.version_info >= (3, 10) else {}
 
 
 # Helper methods
 def make_bs_url(parts):
-    return urlparse(f'https://bibliotheques-specialisees.paris.fr/{parts}').geturl()
+    return urlparse(f'{BS_ROOT}/{parts}').geturl()
 
 
 def get_js_var(source, varname):
@@ -26,14 +50,83 @@ def get_js_var(source, varname):
         return matches.group(1).strip().strip('"'';')
 
 
-def fetch_html(url):
-    r = requests.get(url, timeout=FETCH_TIMEOUT)
-    r.raise_for_status()
-    return BeautifulSoup(r.text, features='html.parser')
+def get_js_vars(source):
+    # All the variables declared in the inline scripts of a page, read in one pass and keyed by their name in lower case.
+    # Like get_js_var, a variable declared twice keeps its first value.
+    js_vars = {}
+    for script in SCRIPT_REGEX.finditer(source):
+        pos, end = script.start(1), script.end(1)
+        while True:
+            matches = JS_VAR_REGEX.search(source, pos, end)
+            if not matches:
+                break
+            js_vars.setdefault(matches.group(1).lower(), matches.group(2).strip().strip('"'';'))
+            pos = matches.start(2) # The rest of the line may declare other variables
+    return js_vars
+
+
+def intern(value):
+    # The strings shared by many documents, like the names of the properties, are kept once in memory
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def parse_html(text, parse_only=None):
+    return BeautifulSoup(text, features=HTML_PARSER, parse_only=parse_only)
+
+
+def fetch_html(url, transport=None):
+    return fetch_page(url, transport).soup
+
+
+def fetch_page(url, transport=None):
+    r = (transport or default_transport()).get_cached(url)
+    return HtmlPage(r.text)
+
+
+class HtmlPage:
+
+    # The source of a page. Its inline JS variables are read from the raw text in one pass,
+    # and the HTML tree is only parsed if it is needed.
+    def __init__(self, text):
+        self.text = text
+        self.__js_vars = None
+        self.__soup = None
+
+    @property
+    def js_vars(self):
+        if self.__js_vars is None:
+            self.__js_vars = get_js_vars(self.text)
+        return self.__js_vars
+
+    def js_var(self, varname):
+        return self.js_vars.get(varname.lower())
+
+    @property
+    def soup(self):
+        if self.__soup is None:
+            self.__soup = parse_html(self.text)
+        return self.__soup
+
+
+def bounded_map(fn, items, workers):
+    # Like Executor.map, but only a few items are submitted ahead of the consumer
+    # and those are cancelled if the consumer stops early.
+    with cf.ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
 
 
 # Content classes
-@dataclass(frozen=True)
+@dataclass(frozen=True, **SLOTTED)
 class Document:
     url: str
     ark: str
@@ -45,6 +138,7 @@ class Document:
     images: field(default_factory=tuple)
     children_urls: field(default_factory=tuple)
     where_to_find_it: str = ''
+    transport: Transport = field(default=None, repr=False, compare=False)
 
     def get_prop(self, prop_name = ''):
         prop = self.properties.get(prop_name)
@@ -57,14 +151,32 @@ class Document:
 
     @property
     def children(self):
-        for children in self.children_urls:
-            yield DocumentBuilder(children).build()
+        # The children are built concurrently but yielded in order
+        def build(children):
+            return DocumentBuilder(children, transport=self.transport).build()
+        yield from bounded_map(build, self.children_urls, CHILDREN_WORKERS)
+
+    @property
+    async def achildren(self):
+        # The children are built concurrently but yielded in order. Like bounded_map, only CHILDREN_WORKERS
+        # children are built ahead of the consumer, and those are cancelled if the consumer stops early.
+        pending = deque()
+        try:
+            for children in self.children_urls:
+                pending.append(asyncio.ensure_future(AsyncDocumentBuilder(children, transport=self.transport).build()))
+                if len(pending) >= CHILDREN_WORKERS:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for build in pending:
+                build.cancel()
 
     def is_collection(self):
         return self.category in COLLECTION_TYPES or len(self.children_urls)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, **SLOTTED)
 class TiledImage:
     iid: str
     ark: str # TODO : replace with gallipy ARK objects
@@ -80,7 +192,7 @@ class TiledImage:
     height: int = 0
     tile_size: int = 0
     overlap: int = 0
-    __cache: dict = field(default_factory=dict, repr=False, init=False) # TODO : cache on disk instead of in memory
+    transport: Transport = field(default=None, repr=False, compare=False)
 
     @property
     def id(self):
@@ -92,24 +204,42 @@ class TiledImage:
         max_zoom = math.floor(math.log2(max_n))
         return 10 + max_zoom # The base zoom is 10
 
-    def content(self, zoom_level=None, callback=None, caching=True):
+    # If caching is True, the tiles are read from and saved to the default tile cache (see grabs.cache),
+    # so that the image can be untiled again without downloading them.
+    # If stream_to is set, the image is written to this TIFF file while it is untiled and
+    # (stream_to, success_rate) is returned. Only one row of tiles is held in memory at once.
+    # If region (left, top, right, bottom) is set, only this area of the image is untiled. Its values are
+    # pixels at zoom_level if they are integers, or fractions of the width and height if they are floats.
+    def content(self, zoom_level=None, callback=None, caching=True, workers=None, stream_to=None, region=None):
 
         zoom_level = zoom_level or self.max_zoom
-        cached = self.__cache.get(zoom_level) if caching else None
-
-        if cached:
-            return cached
-
+        cache = default_cache() if caching else None
         callbacks = [callback] if callback else []
-        if caching:
-            callbacks.append(self.__cache_callback)
 
-        future = Untiler().untile(self, zoom_level, callbacks=callbacks)
+        future = Untiler().untile(self, zoom_level, callbacks=callbacks, workers=workers, stream_to=stream_to,
+                                  cache=cache, region=region)
 
         return future.result() if not callback else future
 
-    def __cache_callback(self, zoom_level, data):
-        self.__cache[zoom_level] = data.result() # dicts are thread safe
+    # Untiles the image at several zoom levels at once, fetching only the tiles of the highest one.
+    # Returns {zoom_level: (content, success_rate)}, see Untiler.pyramid
+    def pyramid(self, zoom_levels, caching=True, workers=None, stream_to=None, region=None):
+        cache = default_cache() if caching else None
+        return Untiler.pyramid(self, zoom_levels, workers=workers, stream_to=stream_to, cache=cache, region=region)
+
+    # Copies the original tiles of the image to a local DeepZoom image in directory, see Untiler.mirror
+    def mirror(self, directory, zoom_levels=None, caching=True, workers=None, region=None):
+        cache = default_cache() if caching else None
+        return Untiler.mirror(self, directory, zoom_levels, workers=workers, cache=cache, region=region)
+
+    # Fetches again the missing tiles of a result returned by content(), see Untiler.repair
+    def repair(self, result, retries=REPAIR_RETRIES, workers=None):
+        return Untiler.repair(result, retries, workers)
+
+    async def acontent(self, zoom_level=None, caching=True, workers=None, region=None):
+        zoom_level = zoom_level or self.max_zoom
+        cache = default_cache() if caching else None
+        return await AsyncUntiler.untile(self, zoom_level, workers=workers, cache=cache, region=region)
 
 
 # Builders
@@ -118,41 +248,63 @@ class TiledImageBuilder:
     # A tile image can be constructed from the url of either the manifest or the viewer of that image.
     # The remote location of the tiles can be set with tiles_url.
     # If tiles_urls is not set, the location of the tiles will be deduced from the manifest url.
-    def __init__(self, viewer_url=None, manifest_url=None, tiles_url=None):
+    # All the requests are sent through transport, or the default transport if not set.
+    def __init__(self, viewer_url=None, manifest_url=None, tiles_url=None, transport=None):
         if not (viewer_url or manifest_url):
             raise ValueError("At least one of viewer_url or manifest_url must be passed to the constructor.")
         self.manifest_url = urlparse(manifest_url).geturl() if manifest_url else None
         self.viewer_url = urlparse(viewer_url).geturl() if viewer_url else None
         self.tiles_url = urlparse(tiles_url).geturl() if tiles_url else None
+        self.transport = transport or default_transport()
 
     def build(self):
+        viewer_page = fetch_page(self.viewer_url, self.transport) if self.viewer_url else None
+        image_metadata = self._read_viewer(viewer_page)
+        manifest = self.transport.get_cached(self._manifest_query_url()).text
+        return self._make_image(image_metadata, manifest)
+
+    # The steps below don't do any I/O, they are shared with AsyncTiledImageBuilder.
+    def _read_viewer(self, page):
 
         image_metadata = { 'iid': '', 'ark': ''}
 
         # We use the viewer to retrieve most of the image metadata
         if self.viewer_url:
-            image_metadata['viewer_url'] = self.viewer_url
-            source = fetch_html(self.viewer_url).text
-            image_metadata['iid'] = get_js_var(source, 'iid')
-            image_metadata['ark'] = get_js_var(source, 'ark')
+            with metrics.timed('parse_seconds', page='viewer'):
+                iid = page.js_var('iid') # All the variables of the page are read on the first access
+            ark = page.js_var('ark')
 
-            ark_parts = re.search(r'(.+)/v(\d+)', image_metadata['ark']) # TODO : use Gallipy
+            ark_parts = re.search(r'(.+)/v(\d+)', ark) # TODO : use Gallipy
             image_number = int(ark_parts.group(2))
             parent_ark = ark_parts.group(1)
-            parent_url = make_bs_url(parent_ark)
+            parent_url = self.transport.url(parent_ark)
 
-            picture_list = get_js_var(source, 'pictureList')
+            picture_list = page.js_var('pictureList')
             pictures = json.loads(picture_list)
-            mdata = pictures[image_number-1]
+            image_metadata = self._read_picture(iid, ark, pictures[image_number-1])
+            image_metadata['parent_url'] = parent_url
+
+        return image_metadata
+
+    # An entry of the pictureList of a document or a viewer holds the metadata of one image
+    def _read_picture(self, iid, ark, mdata):
+        if not self.manifest_url:
+            self.manifest_url = self.transport.url(mdata["deepZoomManifest"])
 
-            if not self.manifest_url:
-                self.manifest_url = make_bs_url(mdata["deepZoomManifest"])
+        return {'viewer_url': self.viewer_url,
+                'iid': iid,
+                'ark': ark,
+                'manifest_url': self.manifest_url,
+                'title': mdata["pagination"],
+                'description': mdata["description"]}
+
+    def _manifest_query_url(self):
+        query = f'/in/rest/pictureListSVC/getTileSource?deepZoomManifest={self.manifest_url}'
+        return self.transport.url(query)
 
-            image_metadata['manifest_url'] = self.manifest_url
-            image_metadata['title'] = mdata["pagination"]
-            image_metadata['description'] = mdata["description"]
+    def _make_image(self, image_metadata, manifest):
 
-        manifest_data = self.__fetch_manifest()
+        manifest_data = self.__parse_manifest(manifest)
         image_metadata.update(manifest_data)
 
         if not manifest_data:
@@ -171,18 +323,15 @@ class TiledImageBuilder:
 
         image_metadata['manifest_url'] = self.manifest_url
         image_metadata['tiles_url'] = self.tiles_url
+        image_metadata['transport'] = self.transport
         return TiledImage(**image_metadata)
 
-    def __fetch_manifest(self):
-        query = f'/in/rest/pictureListSVC/getTileSource?deepZoomManifest={self.manifest_url}'
-        url = make_bs_url(query)
-        r = requests.get(url)
-        r.raise_for_status()
-        json_txt = r.text[1:-1].replace('\\','')
+    def __parse_manifest(self, manifest):
+        json_txt = manifest[1:-1].replace('\\','')
         data = json.loads(json_txt).get("Image")
         try:
             return {
-                'format': data['Format'],
+                'format': intern(data['Format']),
                 'width': data['Size']['Width'],
                 'height': data['Size']['Height'],
                 'overlap': data['Overlap'],
@@ -193,40 +342,106 @@ class TiledImageBuilder:
             raise ValueError(f"Cannot fetch image metadata from manifest <{self.manifest_url}>. Fetched {data}.")
 
 
+class AsyncTiledImageBuilder(TiledImageBuilder):
+
+    # Builds the image like TiledImageBuilder, awaiting the requests instead of blocking on them.
+    # The pages are read in the threads of the transport too, so that parsing does not block the event loop.
+    async def build(self):
+        atransport = self.transport.asynchronous()
+        image_metadata = await atransport.run(self.__read_viewer_page)
+        manifest = (await atransport.get_cached(self._manifest_query_url())).text
+        return await atransport.run(self._make_image, image_metadata, manifest)
+
+    def __read_viewer_page(self):
+        viewer_page = fetch_page(self.viewer_url, self.transport) if self.viewer_url else None
+        return self._read_viewer(viewer_page)
+
+
 class DocumentBuilder:
 
-    def __init__(self, url):
+    # The page of the document is fetched when the builder is created, unless its source is given as an HtmlPage.
+    def __init__(self, url, transport=None, source=None):
         self.document_url = urlparse(url).geturl()
-        self.source = fetch_html(self.document_url)
+        self.transport = transport or default_transport()
+        self.source = source if source is not None else fetch_page(self.document_url, self.transport)
 
     def build(self):
+        document_metadata = self._read_document()
+        images = self._read_images(document_metadata)
+        self.source = None # Everything was read from the page, it is released before the next requests
+
+        # The images are built from the pictureList of the document, only their manifests are fetched.
+        def build_image(image):
+            builder, image_metadata = image
+            manifest = self.transport.get_cached(builder._manifest_query_url()).text
+            return builder._make_image(image_metadata, manifest)
+
+        with cf.ThreadPoolExecutor(MANIFEST_WORKERS) as executor:
+            document_metadata['images'] = tuple(executor.map(build_image, images))
+
+        children_urls = DocumentBuilder.__get_links_to_childrens(document_metadata['iid'], self.transport)
+        document_metadata['children_urls'] = children_urls
+
+        return Document(**document_metadata)
+
+    # The steps below don't do any I/O, they are shared with AsyncDocumentBuilder.
+    def _read_document(self):
         document_metadata = {}
-        source_txt = self.source.text
         document_metadata['url'] = self.document_url
         document_metadata['ark'] = self.__get_ark()
-        document_metadata['category'] = get_js_var(source_txt, 'zmat')
-        document_metadata['iid'] = get_js_var(source_txt, 'instanceiid')
-        document_metadata['parent_iid'] = get_js_var(source_txt, 'parent_iid')
-        document_metadata['properties'] = self.__get_props()
-        document_metadata['properties_lang'] = get_js_var(source_txt, 'currLocale')
+        with metrics.timed('parse_seconds', page='document'):
+            document_metadata['category'] = intern(self.source.js_var('zmat'))
+            document_metadata['iid'] = self.source.js_var('instanceiid')
+            document_metadata['parent_iid'] = self.source.js_var('parent_iid')
+            document_metadata['properties'] = self.__get_props()
+        document_metadata['properties_lang'] = intern(self.source.js_var('currLocale'))
         document_metadata['where_to_find_it'] = 'Not yet implemented' # TODO Not yet implemented in the builder
-        images = []
+        document_metadata['transport'] = self.transport
+        return document_metadata
 
-        picture_list = get_js_var(source_txt, 'pictureList')  # Is there any image attached to this document ?
+    # Returns a (TiledImageBuilder, image metadata) pair for each image of the document.
+    # The images have the iid of the document, and an ark and a viewer of the form {document ark}/v0001.
+    # Their parent is the document, as for the images built from their viewer.
+    def _read_images(self, document_metadata):
+        images = []
+        picture_list = self.source.js_var('pictureList')  # Is there any image attached to this document ?
         if picture_list:
-            links = json.loads(picture_list)
-            for idx, link in enumerate(links):
-                manifest = make_bs_url(link['deepZoomManifest'])
-                view = f'{document_metadata["ark"]}/v{str(idx).zfill(4)}'
-                view_url = make_bs_url(view)
-                image = TiledImageBuilder(view_url, manifest_url=manifest).build()
-                images.append(image)
-        document_metadata['images'] = images
-
-        children_urls = DocumentBuilder.__get_links_to_childrens(document_metadata['iid'])
-        document_metadata['children_urls'] = children_urls
+            parent_url = self.transport.url(document_metadata['ark'])
+            for idx, picture in enumerate(json.loads(picture_list)):
+                ark = f'{document_metadata["ark"]}/v{str(idx + 1).zfill(4)}'
+                builder = TiledImageBuilder(self.transport.url(ark), transport=self.transport)
+                image_metadata = builder._read_picture(document_metadata['iid'], ark, picture)
+                image_metadata['parent_url'] = parent_url
+                images.append((builder, image_metadata))
+        return images
 
-        return Document(**document_metadata)
+    @staticmethod
+    def _geoquery_url(document_iid, page, transport):
+        # the childrens are added dynamically so we can't get them directly from the page source
+        query = f'in/rest/searchSVC/jsonp/geoquery?callback=&query=*' \
+                f'&fq=parent_iid:"{document_iid}"' \
+                f'&fl={SUBDOCS_ID_FIELD}' \
+                f'&pageSize={N_SUBDOCS_AT_ONCE}' \
+                f'&pageNo={page}'
+        return transport.url(query)
+
+    @staticmethod
+    def _read_geoquery(text):
+        json_str = text[1:-4] # r returns a javascript call "(json);" but we only want the json
+        results = json.loads(json_str).get("results") or []
+        return [result.get(SUBDOCS_ID_FIELD).get("value") for result in results]
+
+    @staticmethod
+    def _geoquery_pages():
+        # The next pages are only fetched if the first one is full, then GEOQUERY_PAGES_AT_ONCE at a time
+        # until a page is not full, see _is_last_page.
+        yield [1]
+        for first in range(2, SUBDOCS_MAX_PAGES, GEOQUERY_PAGES_AT_ONCE):
+            yield list(range(first, min(first + GEOQUERY_PAGES_AT_ONCE, SUBDOCS_MAX_PAGES)))
+
+    @staticmethod
+    def _is_last_page(results):
+        return any(len(arks) < N_SUBDOCS_AT_ONCE for arks in results)
 
     def __get_ark(self):
         m = re.search(r'ark:\/[^\?]+\/[^\?]+', self.document_url)
@@ -234,35 +449,35 @@ class DocumentBuilder:
             return m.group(0)
 
     @staticmethod
-    def __get_links_to_childrens(document_iid):
-        f_name = 'InterviewId'
-        children = set()
-        for k in range(1, SUBDOCS_MAX_PAGES):
-            # the childrens are added dynamically so we can't get them directly from the page source
-            query = f'https://bibliotheques-specialisees.paris.fr/in/rest/searchSVC/jsonp/geoquery?callback=&query=*' \
-                    f'&fq=parent_iid:"{document_iid}"' \
-                    f'&fl={f_name}' \
-                    f'&pageSize={N_SUBDOCS_AT_ONCE}' \
-                    f'&pageNo={k}'
-            r = requests.get(query)
-            r.raise_for_status()
-            json_str = r.text[1:-4] # r returns a javascript call "(json);" but we only want the json
-
-            results = json.loads(json_str).get("results")
-            if not results:
-                break
-            [children.add(result.get(f_name).get("value")) for result in results]
-
-        return [make_bs_url(ark) for ark in children]
+    def __get_links_to_childrens(document_iid, transport):
+        def fetch_page(k):
+            r = transport.get_cached(DocumentBuilder._geoquery_url(document_iid, k, transport))
+            return DocumentBuilder._read_geoquery(r.text)
+
+        children = {} # A dict keeps the children in order
+        with cf.ThreadPoolExecutor(GEOQUERY_PAGES_AT_ONCE) as executor:
+            for pages in DocumentBuilder._geoquery_pages():
+                results = list(executor.map(fetch_page, pages))
+                for arks in results:
+                    children.update(dict.fromkeys(arks))
+                if DocumentBuilder._is_last_page(results):
+                    break
+
+        return tuple(transport.url(ark) for ark in children)
 
     def __get_props(self):
-        prop_containers = self.source.findAll("div", {"class":"NormalField"})
+        # The page is parsed from the first property on, the menus and scripts before it are skipped
+        start = PROPERTIES_START_REGEX.search(self.source.text)
+        if not start:
+            return {}
+        fields = parse_html(self.source.text[start.start():], PROPERTIES_STRAINER)
+        prop_containers = fields.findAll("div", {"class":"NormalField"})
         props = {}
         for container in prop_containers:
             prop = [cls for cls in container['class'] if 'property' in cls][0]
-            prop = prop.replace('property_','') # remove the prefix
+            prop = intern(prop.replace('property_','')) # remove the prefix
             children = container.findAll("div", recursive=False)
-            propname = children[0].find("span").text.strip()
+            propname = intern(children[0].find("span").text.strip())
             propvalue = children[1].find("div").text.strip()
             propentry = props.get(prop)
             if propentry:
@@ -272,4 +487,57 @@ class DocumentBuilder:
             else:
                 props[prop] = {'name': propname,
                                'values': [propvalue]}
-        return props
\ No newline at end of file
+        # The tree is full of reference cycles, it is freed now rather than when the garbage collector finds them
+        fields.decompose()
+        for propentry in props.values():
+            propentry['values'] = tuple(propentry['values'])
+        return props
+
+
+class AsyncDocumentBuilder:
+
+    # Builds the document like DocumentBuilder, awaiting the requests instead of blocking on them.
+    # The pages are read in the threads of the transport too, so that parsing does not block the event loop.
+    def __init__(self, url, transport=None):
+        self.document_url = urlparse(url).geturl()
+        self.transport = transport or default_transport()
+
+    async def build(self):
+        atransport = self.transport.asynchronous()
+        # The page is not kept while the manifests and children are awaited
+        document_metadata, images = await atransport.run(self.__read_page)
+
+        async def build_image(image):
+            image_builder, image_metadata = image
+            manifest = (await atransport.get_cached(image_builder._manifest_query_url())).text
+            return await atransport.run(image_builder._make_image, image_metadata, manifest)
+
+        document_metadata['images'] = tuple(await asyncio.gather(*(build_image(image) for image in images)))
+
+        children_urls = await AsyncDocumentBuilder.__get_links_to_childrens(document_metadata['iid'], self.transport)
+        document_metadata['children_urls'] = children_urls
+
+        return Document(**document_metadata)
+
+    def __read_page(self):
+        builder = DocumentBuilder(self.document_url, self.transport)
+        document_metadata = builder._read_document()
+        return document_metadata, builder._read_images(document_metadata)
+
+    @staticmethod
+    async def __get_links_to_childrens(document_iid, transport):
+        atransport = transport.asynchronous()
+
+        async def fetch_page(k):
+            r = await atransport.get_cached(DocumentBuilder._geoquery_url(document_iid, k, transport))
+            return DocumentBuilder._read_geoquery(r.text)
+
+        children = {} # A dict keeps the children in order
+        for pages in DocumentBuilder._geoquery_pages():
+            results = await asyncio.gather(*(fetch_page(k) for k in pages))
+            for arks in results:
+                children.update(dict.fromkeys(arks))
+            if DocumentBuilder._is_last_page(results):
+                break
+
+        return tuple(transport.url(ark) for ark in children)
@@ -0,0 +1,132 @@
+import struct
+from PIL import Image
+
+# Field types and tags of the baseline TIFF specification
+SHORT = 3
+LONG = 4
+TYPE_FORMATS = {SHORT: 'H', LONG: 'I'}
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC_INTERPRETATION = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+EXTRA_SAMPLES = 338
+
+# PIL mode : (photometric interpretation, extra samples)
+MODES = {'L': (1, []), 'RGB': (2, []), 'RGBA': (2, [2])} # 2 = unassociated alpha
+MAX_FILE_SIZE = 2 ** 32 - 1 # Offsets are 32 bits long in a classic TIFF file
+
+
+class StripTiffWriter:
+
+    # Writes an uncompressed TIFF image strip by strip, from top to bottom, so that the
+    # whole image never has to be held in memory. The directory of the image is written on close.
+    def __init__(self, path, width, height, mode, rows_per_strip):
+        if mode not in MODES:
+            raise ValueError(f"Cannot write images of mode {mode} to a TIFF file, expected one of {list(MODES)}.")
+        if width * height * len(mode) > MAX_FILE_SIZE - 2 ** 16:
+            raise ValueError(f"An image of {width}x{height} pixels is too large for a TIFF file.")
+        self.path = path
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.rows_per_strip = rows_per_strip
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        self.rows = 0
+        self.file = open(path, 'wb')
+        self.file.write(b'II*\x00' + struct.pack('<I', 0)) # The offset of the directory is known on close
+
+    def write_strip(self, image):
+        if image.mode != self.mode or image.width != self.width:
+            raise ValueError(f"Expected a strip of mode {self.mode} and width {self.width}, got {image.mode} {image.size}.")
+        if image.height != min(self.rows_per_strip, self.height - self.rows):
+            raise ValueError(f"Unexpected strip height {image.height} at row {self.rows} of {self.path}.")
+        data = image.tobytes()
+        self.strip_offsets.append(self.file.tell())
+        self.strip_byte_counts.append(len(data))
+        self.file.write(data)
+        self.rows += image.height
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            if self.rows != self.height:
+                raise ValueError(f"Only {self.rows} of the {self.height} rows were written to {self.path}.")
+            self.__write_directory()
+        finally:
+            self.file.close()
+
+    def __write_directory(self):
+        photometric, extra_samples = MODES[self.mode]
+        entries = [(IMAGE_WIDTH, LONG, [self.width]),
+                   (IMAGE_LENGTH, LONG, [self.height]),
+                   (BITS_PER_SAMPLE, SHORT, [8] * len(self.mode)),
+                   (COMPRESSION, SHORT, [1]),
+                   (PHOTOMETRIC_INTERPRETATION, SHORT, [photometric]),
+                   (STRIP_OFFSETS, LONG, self.strip_offsets),
+                   (SAMPLES_PER_PIXEL, SHORT, [len(self.mode)]),
+                   (ROWS_PER_STRIP, LONG, [self.rows_per_strip]),
+                   (STRIP_BYTE_COUNTS, LONG, self.strip_byte_counts),
+                   (PLANAR_CONFIGURATION, SHORT, [1])]
+        if extra_samples:
+            entries.append((EXTRA_SAMPLES, SHORT, extra_samples))
+
+        # Directories must start on a word boundary
+        if self.file.tell() % 2:
+            self.file.write(b'\x00')
+        directory_offset = self.file.tell()
+        values_offset = directory_offset + 2 + 12 * len(entries) + 4
+
+        directory = struct.pack('<H', len(entries))
+        values = b''
+        for tag, field_type, field_values in entries:
+            packed = struct.pack(f'<{len(field_values)}{TYPE_FORMATS[field_type]}', *field_values)
+            if len(packed) <= 4:
+                directory += struct.pack('<HHI', tag, field_type, len(field_values)) + packed.ljust(4, b'\x00')
+            else:
+                offset = values_offset + len(values)
+                directory += struct.pack('<HHII', tag, field_type, len(field_values), offset)
+                values += packed
+        directory += struct.pack('<I', 0) # No other directory
+
+        self.file.write(directory + values)
+        self.file.seek(4)
+        self.file.write(struct.pack('<I', directory_offset))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type:
+            self.file.close() # Do not hide the original error
+        else:
+            self.close()
+
+
+def patch_strips(path, image, x, y):
+    # Overwrites the area of an uncompressed strip TIFF file, e.g. written by StripTiffWriter,
+    # that starts at (x, y) with the pixels of image.
+    with Image.open(path) as tiff:
+        width, mode = tiff.width, tiff.mode
+        offsets = tiff.tag_v2[STRIP_OFFSETS]
+        rows_per_strip = tiff.tag_v2.get(ROWS_PER_STRIP, tiff.height)
+        compression = tiff.tag_v2.get(COMPRESSION, 1)
+    if compression != 1 or mode != image.mode or mode not in MODES:
+        raise ValueError(f"Cannot patch {path}: expected an uncompressed TIFF file of mode {image.mode}.")
+
+    samples = len(mode)
+    data = image.tobytes()
+    line_size = image.width * samples
+    with open(path, 'r+b') as tiff:
+        for line in range(image.height):
+            row = y + line
+            tiff.seek(offsets[row // rows_per_strip] + ((row % rows_per_strip) * width + x) * samples)
+            tiff.write(data[line * line_size:(line + 1) * line_size])
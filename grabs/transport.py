@@ -0,0 +1,176 @@
+import time
+import asyncio
+import requests
+import threading
+import weakref
+import concurrent.futures as cf
+from functools import partial
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .ratelimit import RateLimiter
+from . import metrics
+
+BS_ROOT = 'https://bibliotheques-specialisees.paris.fr'
+FETCH_TIMEOUT = 20 # in seconds
+POOL_SIZE = 32 # Should be at least the number of threads sharing the transport
+RETRIES = 3
+BACKOFF_FACTOR = 0.5 # Retries wait for 0.5s, 1s, 2s, ...
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class OfflineError(requests.exceptions.ConnectionError):
+    pass
+
+
+class Transport:
+
+    # All the network I/O of grabs goes through a transport, which holds a pool of keep-alive connections
+    # shared by all the threads using it. Failed requests (connection errors, 5xx and 429 responses)
+    # are retried with an exponential backoff before an exception is raised.
+    # The root url of the library can be changed to point grabs at another server.
+    # All the requests go through a rate limiter, which adapts the number of requests sent at once to each host
+    # (up to pool_size) to its errors and latency. max_rps and max_bps cap the requests and bytes per second
+    # received from each host.
+    # The metadata are fetched through response_cache if set, see get_cached. If offline is True, no request
+    # is sent at all: only the cached responses (and the cached tiles) are used, the others raise an OfflineError.
+    def __init__(self, root=BS_ROOT, pool_size=POOL_SIZE, timeout=FETCH_TIMEOUT, retries=RETRIES,
+                 backoff_factor=BACKOFF_FACTOR, session=None, max_rps=None, max_bps=None, limiter=None,
+                 response_cache=None, offline=False):
+        self.root = root.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.response_cache = response_cache
+        self.offline = offline
+        self.limiter = limiter or RateLimiter(pool_size, max_rps=max_rps, max_bps=max_bps)
+        self.session = session or requests.Session()
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUSES,
+                      raise_on_status=False) # Let raise_for_status() report the last error
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.__async = None
+        self.__lock = threading.Lock()
+
+    def url(self, parts):
+        return urlparse(f'{self.root}/{parts}').geturl()
+
+    def get(self, url, **kwargs):
+        if self.offline:
+            raise OfflineError(f'Cannot fetch {url} while offline')
+        kwargs.setdefault('timeout', self.timeout)
+        r = self.limiter.send(url, partial(self.__send, url, **kwargs))
+        r.raise_for_status()
+        return r
+
+    def __send(self, url, **kwargs):
+        # The time of a request includes its retries, which are counted apart
+        start = time.perf_counter()
+        try:
+            r = self.session.get(url, **kwargs)
+        except requests.exceptions.RequestException as err:
+            metrics.count('request_errors_total', error=type(err).__name__)
+            raise
+        metrics.observe('request_seconds', time.perf_counter() - start, status=r.status_code)
+        metrics.count('response_bytes_total', len(r.content))
+        retries = getattr(r.raw, 'retries', None)
+        if retries and retries.history:
+            metrics.count('request_retries_total', len(retries.history))
+        return r
+
+    def get_cached(self, url, **kwargs):
+        # Like get, but the response is read from the response cache while it is fresh, and revalidated with
+        # a conditional request once it is stale. Only the responses to requests without parameters are cached.
+        if self.response_cache is None or kwargs:
+            return self.get(url, **kwargs)
+        entry = self.response_cache.get(url)
+        if entry and (self.offline or entry.is_fresh(self.response_cache.ttl)):
+            metrics.count('response_cache_total', result='hit')
+            return entry.response()
+        if self.offline:
+            raise OfflineError(f'{url} is not in the response cache {self.response_cache.directory}')
+
+        r = self.get(url, headers=entry.validators() if entry else None)
+        if r.status_code == 304 and entry:
+            metrics.count('response_cache_total', result='revalidated')
+            return self.response_cache.refresh(entry, r).response()
+        metrics.count('response_cache_total', result='miss')
+        if r.status_code == 200:
+            self.response_cache.put(url, r)
+        return r
+
+    def asynchronous(self):
+        # The asynchronous view of this transport, sharing its pool of connections
+        with self.__lock:
+            if self.__async is None:
+                self.__async = AsyncTransport(self)
+            return self.__async
+
+    def close(self):
+        if self.__async:
+            self.__async.close()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # A transport is shared infrastructure, not data: copies of the documents and images
+    # (e.g. with dataclasses.asdict) keep a reference to the same transport.
+    def __deepcopy__(self, memo):
+        return self
+
+
+class AsyncTransport:
+
+    # Runs the blocking calls of a transport in a pool of threads so that they can be awaited
+    # without blocking the event loop. A semaphore bounds the number of calls in flight,
+    # the others wait on the event loop.
+    def __init__(self, transport=None, limit=None):
+        self.transport = transport or default_transport()
+        self.limit = limit or self.transport.pool_size
+        self.__executor = cf.ThreadPoolExecutor(self.limit)
+        self.__semaphores = weakref.WeakKeyDictionary() # asyncio semaphores are bound to one event loop
+
+    def __semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self.__semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.__semaphores[loop] = asyncio.Semaphore(self.limit)
+        return semaphore
+
+    async def run(self, fn, *args, **kwargs):
+        async with self.__semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.__executor, partial(fn, *args, **kwargs))
+
+    async def get(self, url, **kwargs):
+        return await self.run(self.transport.get, url, **kwargs)
+
+    async def get_cached(self, url, **kwargs):
+        return await self.run(self.transport.get_cached, url, **kwargs)
+
+    def close(self):
+        self.__executor.shutdown(wait=False)
+
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+
+def default_transport():
+    global _default_transport
+    with _default_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+        return _default_transport
+
+
+def set_default_transport(transport):
+    global _default_transport
+    with _default_lock:
+        _default_transport = transport
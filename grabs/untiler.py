@@ -1,14 +1,105 @@
+import os
+import asyncio
 import requests
 import math
+import tempfile
+import time
+import threading
 import concurrent.futures as cf
+import multiprocessing
 import logging as log
+from contextlib import nullcontext
 from PIL import (Image, ImageDraw)
 from io import BytesIO
+from pathlib import Path
 from dataclasses import (dataclass)
-from . import resource
+from . import (resource, metrics)
+from .transport import default_transport
+from .tiff import (StripTiffWriter, patch_strips)
+from .cache import TileCache
 
 MODES_FORMATS = {'jpg': 'RGB', 'jpeg': 'RGB', 'png': 'RGBA'}
-FETCH_TIMEOUT = 20
+TILE_WORKERS = 8 # Number of tiles fetched at once for a single image
+MAX_CONCURRENT_TILES = 32 # Number of tiles fetched at once across all the images being untiled
+REPAIR_RETRIES = 3
+REPAIR_BACKOFF = 2 # in seconds, doubled after each round of retries
+DZI_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{format}" Overlap="{overlap}" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+'''
+
+_tile_slots = threading.BoundedSemaphore(MAX_CONCURRENT_TILES)
+_decode_pool = None # Tiles are decoded in the calling threads if not set
+
+
+def set_max_concurrent_tiles(n):
+    # Only affects the images untiled after the call, running untilings keep their own slots.
+    global _tile_slots
+    if n < 1:
+        raise ValueError(f"The maximum number of concurrent tiles must be at least 1, got {n}.")
+    _tile_slots = threading.BoundedSemaphore(n)
+
+
+def set_decode_processes(n):
+    # Decodes the tiles in a pool of n processes, so that they are not bound to a single core by the GIL.
+    # The tiles are decoded in threads if n is 0 or None.
+    global _decode_pool
+    if n is not None and n < 0:
+        raise ValueError(f"The number of decoding processes must be positive, got {n}.")
+    pool, _decode_pool = _decode_pool, None
+    if pool:
+        pool.shutdown()
+    if n:
+        _decode_pool = cf.ProcessPoolExecutor(n, mp_context=multiprocessing.get_context('spawn'))
+
+
+def save_image(image, path, **params):
+    # Encoded in the calling thread: Pillow releases the GIL while encoding, and sending
+    # the pixels to another process would copy the whole image several times
+    with metrics.timed('encode_seconds', image=Path(path).name):
+        image.save(path, **params)
+
+
+def _decode_tile(tile, tile_size, overlap, mode):
+    # Returns the index of the tile, its size, and the mode, size and pixels of its non-overlapping area
+    # converted to mode, the mode of the untiled image, so that no palette is lost with the pixels
+    index = tile[0], tile[1]
+    image = Image.open(BytesIO(tile[2]))
+    # FIX: Tiles of the firt column (resp. first row) seem to have
+    # no overlapping area on the left (resp. top) border.
+    overlap_x = overlap if index[0] else 0
+    overlap_y = overlap if index[1] else 0
+    crop_rectangle = (overlap_x,
+                      overlap_y,
+                      tile_size + overlap_x,
+                      tile_size + overlap_y)
+    non_overlapping = image.crop(crop_rectangle)
+    if non_overlapping.mode != mode:
+        non_overlapping = non_overlapping.convert(mode)
+    return index, image.size, non_overlapping.mode, non_overlapping.size, non_overlapping.tobytes()
+
+
+class UntileResult(tuple):
+
+    # The (content, success_rate) pair returned by the untilers, where content is either the
+    # untiled image or the path of the file it was streamed to.
+    # failed_tiles maps the (column, row) of each tile that could not be fetched to its url,
+    # so that the result can be repaired with Untiler.repair.
+    def __new__(cls, content, success_rate, query=None, failed_tiles=None):
+        result = super().__new__(cls, (content, success_rate))
+        result.query = query
+        result.failed_tiles = dict(failed_tiles or {})
+        return result
+
+    @property
+    def content(self):
+        return self[0]
+
+    @property
+    def success_rate(self):
+        return self[1]
+
 
 @dataclass(frozen=True)
 class _UntileQuery:
@@ -16,12 +107,43 @@ class _UntileQuery:
     # the circular dependency between _UntileQuery and TiledImage
     image: 'resource.TiledImage'
     zoom_level: int
+    cache: TileCache = None
+    # (left, top, right, bottom) in pixels at the zoom level of the query if the values are integers,
+    # or as fractions of the width and height of the image if any of them is a float.
+    region: tuple = None
 
     def __post_init__(self):
         mz = self.image.max_zoom
         zl = self.zoom_level
         if zl > mz:
             raise ValueError(f"Zoom level ({zl}) is greater than the maximum possible zoom ({mz}) for {self.image.file_name}.")
+        self.box() # Check the region
+
+    # The area of the image to untile, in pixels at the zoom level of the query
+    def box(self):
+        width, height = self.width(), self.height()
+        left, top, right, bottom = _UntileQuery.region_box(self.region, width, height)
+        if left >= right or top >= bottom:
+            raise ValueError(f"The region {self.region} does not intersect the image {self.image.file_name} " \
+                             f"of {width}x{height} pixels at zoom level {self.zoom_level}.")
+        return left, top, right, bottom
+
+    # The region clipped to an image of width x height pixels, empty if they do not intersect
+    @staticmethod
+    def region_box(region, width, height):
+        if not region:
+            return 0, 0, width, height
+
+        if any(isinstance(v, float) for v in region):
+            # e.g. (0.5, 0.5, 1, 1), but not (0.5, 0.5, 100, 100) which mixes fractions and pixels
+            if not all(0 <= v <= 1 for v in region):
+                raise ValueError(f"The fractions of a region must be between 0 and 1, and cannot be mixed with pixels, got {region}.")
+            left, top, right, bottom = region
+            left, top, right, bottom = round(left * width), round(top * height), round(right * width), round(bottom * height)
+        else:
+            left, top, right, bottom = (int(v) for v in region)
+
+        return max(left, 0), max(top, 0), min(right, width), min(bottom, height)
 
     def width(self):
         return self.image.width // 2 ** (self.image.max_zoom - self.zoom_level)
@@ -36,81 +158,431 @@ class _UntileQuery:
         if max(zl_width, zl_height) < 1:
             log.warning(f'Image at zoom level {self.zoom_level} is smaller than 1 pixel.')
 
-        n_columns = math.ceil(zl_width / self.image.tile_size)
-        n_rows = math.ceil(zl_height / self.image.tile_size)
+        # Only the tiles intersecting the region are listed
+        t_size = self.image.tile_size
+        left, top, right, bottom = self.box()
+        columns = range(left // t_size, math.ceil(right / t_size))
+        rows = range(top // t_size, math.ceil(bottom / t_size))
 
         def url_template(root, zl, col, row, frmt):
             return f'{root}/{zl}/{col}_{row}.{frmt}'
 
         tile_matrix = {}
-        for col_idx in list(range(0, n_columns)):
-            for row_idx in list(range(0, n_rows)):
+        for col_idx in columns:
+            for row_idx in rows:
                 url = url_template(self.image.tiles_url, self.zoom_level, col_idx, row_idx, self.image.format)
                 tile_matrix[col_idx, row_idx] = url
         return tile_matrix
 
+    # Tiles found in the cache are neither downloaded nor counted in the download slots.
+    def fetch_tile(self, index, tile_url, slots=None):
+        key = TileCache.key(self.image.tiles_url, self.zoom_level, *index)
+        data = self.cache.get(key) if self.cache else None
+        if data is not None:
+            metrics.count('tiles_total', source='cache')
+            return index + (data,)
+        with slots or nullcontext():
+            try:
+                data = (self.image.transport or default_transport()).get(tile_url).content
+            except requests.exceptions.RequestException:
+                metrics.count('tiles_failed_total')
+                raise
+        metrics.count('tiles_total', source='network')
+        if self.cache:
+            self.cache.put(key, data)
+        return index + (data,)
+
+
+class _Mosaic:
+
+    # Assembles the tiles of a query into one image. Each tile is pasted on its own
+    # non-overlapping area of the image so the order in which the tiles arrive does not matter.
+    # If box (left, top, right, bottom) is set, only this area of the image is assembled,
+    # otherwise the region of the query. The time spent on the tiles is measured by stopwatch.
+    def __init__(self, query: _UntileQuery, box=None, stopwatch=None):
+        self.query = query
+        self.box = box or query.box()
+        self.stopwatch = stopwatch or metrics.Stopwatch()
+        dims = (self.box[2] - self.box[0], self.box[3] - self.box[1])
+        self.image = Image.new(MODES_FORMATS[query.image.format],dims)
+        self.tile_sizes = {}
+        self.failed_tiles = {}
+        self.__lock = threading.Lock()
+
+    def add(self, tile):
+        with self.stopwatch.measure('decode'):
+            decoded = _Mosaic.decode(self.query, tile)
+        self.paste(decoded)
+
+    # Decoding is the costly part of adding a tile, so it is run apart from pasting,
+    # in the threads fetching the tiles or in the decoding processes.
     @staticmethod
-    def fetch_tile(index, tile_url):
-        r = requests.get(tile_url, timeout=FETCH_TIMEOUT)
-        r.raise_for_status()
-        return index + (r.content,)
+    def decode(query, tile):
+        args = (tile, query.image.tile_size, query.image.overlap, MODES_FORMATS[query.image.format])
+        pool = _decode_pool
+        return pool.submit(_decode_tile, *args).result() if pool else _decode_tile(*args)
+
+    def paste(self, decoded):
+        index, tile_size, mode, size, pixels = decoded
+        with self.stopwatch.measure('paste'):
+            non_overlapping = Image.frombytes(mode, size, pixels)
+            cursor = self.__cursor(index)
+            with self.__lock:
+                self.image.paste(non_overlapping, box=cursor)
+                self.tile_sizes[index] = tile_size
+
+    def fail(self, index, url, err):
+        log.error(f'Error: Unable to load tile {url} in position {index}.\n' \
+                  f'Caused by {err}')
+        with self.__lock:
+            self.failed_tiles[index] = url
+
+    def result(self, n_tiles):
+        # paint the grid on top of the image
+        if Untiler.DRAW_TILES_BOUNDS:
+            t_size = self.query.image.tile_size
+            overlap = self.query.image.overlap
+            draw = ImageDraw.Draw(self.image)
+            for index, (tile_width, tile_height) in self.tile_sizes.items():
+                cursor = self.__cursor(index)
+                # Draw boundaries with overlapping
+                tile_bbox = [cursor[0] - overlap, cursor[1] - overlap * 2, cursor[0] + tile_width - overlap,
+                             cursor[1] + tile_height - overlap * 2]
+                draw.rectangle(tile_bbox, outline='cyan')
+        return UntileResult(self.image, len(self.tile_sizes) / n_tiles, self.query, self.failed_tiles)
+
+    def __cursor(self, index):
+        t_size = self.query.image.tile_size
+        return index[0] * t_size - self.box[0], index[1] * t_size - self.box[1]
 
 
 class Untiler:
 
     DRAW_TILES_BOUNDS = False
 
+    # If stream_to is set, the image is written to this TIFF file strip by strip instead
+    # of being assembled in memory. The future then returns (stream_to, success_rate).
+    # If region is set, only this area of the image is untiled, see _UntileQuery.region
     @staticmethod
-    def untile(image, zoom_level, callbacks):
-        query = _UntileQuery(image,zoom_level)
+    def untile(image, zoom_level, callbacks, workers=None, stream_to=None, cache=None, region=None):
+        query = _UntileQuery(image,zoom_level, cache, region)
 
         def propagate(fut):
             for cb in callbacks:
                 cb(zoom_level, fut)
 
         with cf.ThreadPoolExecutor(1) as executor:
-            future = executor.submit(Untiler.__build_image, query)
+            if stream_to:
+                future = executor.submit(Untiler.__stream_image, query, workers or TILE_WORKERS, stream_to)
+            else:
+                future = executor.submit(Untiler.__build_image, query, workers or TILE_WORKERS)
             if callbacks:
                 future.add_done_callback(propagate)
             return future
 
+    # Untiles the image at several zoom levels, returning {zoom_level: UntileResult} from the highest level down.
+    # Only the highest level is fetched. A lower level is read from its own tiles if they are all
+    # in the cache, otherwise it is downsampled from the level above it, so no more tiles are downloaded.
+    # If stream_to is set, it is the path of the TIFF file of each level formatted with {zoom},
+    # e.g. 'plan_{zoom}.tif'. Since the levels are not held in memory, they are all untiled from their tiles.
+    # If region is set, only this area of the highest level is untiled, and the lower levels are downsampled
+    # from it, see level_regions.
+    @staticmethod
+    def pyramid(image, zoom_levels, workers=None, stream_to=None, cache=None, region=None):
+        results = {}
+        source = None
+        for zoom_level, level_region in sorted(Untiler.level_regions(image, zoom_levels, region).items(), reverse=True):
+            query = _UntileQuery(image, zoom_level, cache, level_region)
+            if stream_to:
+                source = Untiler.untile(image, zoom_level, [], workers, stream_to.format(zoom=zoom_level), cache,
+                                        level_region).result()
+            elif source is None or Untiler.__is_cached(query):
+                source = Untiler.untile(image, zoom_level, [], workers, cache=cache, region=level_region).result()
+            else:
+                source = Untiler.__downsample(source, query)
+            results[zoom_level] = source
+        return results
+
+    # Copies the tiles of the image, byte for byte, to a local DeepZoom image made of directory/{name}.dzi
+    # and of the tiles directory/{name}_files/{zoom}/{col}_{row}.{format}. The tiles are never decoded,
+    # and the tiles already mirrored are not fetched again. All the zoom levels are mirrored if zoom_levels is None,
+    # the levels keep the numbers they have on the server. If region is set, only its tiles are mirrored,
+    # see mirror_levels.
+    # Returns {zoom_level: UntileResult} where the content is the directory of the tiles of each level.
     @staticmethod
-    def __build_image(query: _UntileQuery):
+    def mirror(image, directory, zoom_levels=None, workers=None, cache=None, region=None):
+        name = Path(image.file_name).stem
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        Untiler.__write_file(Path(directory) / f'{name}.dzi',
+                             DZI_TEMPLATE.format(format=image.format, overlap=image.overlap, tile_size=image.tile_size,
+                                                 width=image.width, height=image.height).encode())
+
+        results = {}
+        slots = _tile_slots
+        with cf.ThreadPoolExecutor(workers or TILE_WORKERS) as executor:
+            for zoom_level, level_region in sorted(Untiler.mirror_levels(image, zoom_levels, region).items(), reverse=True):
+                query = _UntileQuery(image, zoom_level, cache, level_region)
+                level_dir = Path(directory) / f'{name}_files' / str(zoom_level)
+                level_dir.mkdir(parents=True, exist_ok=True)
+                tiles_urls = query.tiles_urls()
+                failed_tiles = {}
+                stopwatch = metrics.Stopwatch()
+
+                def mirror_tile(idx, url):
+                    if not Untiler.__tile_path(level_dir, query, idx).exists():
+                        with stopwatch.measure('fetch'):
+                            tile = query.fetch_tile(idx, url, slots)
+                        with stopwatch.measure('write'):
+                            Untiler.__write_tile(level_dir, query, tile)
+
+                futures = {executor.submit(mirror_tile, idx, url): (idx, url) for idx, url in tiles_urls.items()}
+                for future in cf.as_completed(futures):
+                    try:
+                        future.result()
+                    except requests.exceptions.RequestException as err:
+                        idx, url = futures[future]
+                        log.error(f'Error: Unable to load tile {url} in position {idx}.\n' \
+                                  f'Caused by {err}')
+                        failed_tiles[idx] = url
+                n_tiles = len(tiles_urls)
+                stopwatch.emit('mirror', image=image.file_name, zoom_level=zoom_level)
+                results[zoom_level] = UntileResult(str(level_dir), (n_tiles - len(failed_tiles)) / n_tiles, query, failed_tiles)
+        return results
+
+    # Returns {zoom_level: region} for the levels mirrored by mirror: zoom_levels, or all the levels at which
+    # the image is at least one pixel wide and high, see level_regions.
+    @staticmethod
+    def mirror_levels(image, zoom_levels=None, region=None):
+        if not zoom_levels:
+            zoom_levels = [zl for zl in range(image.max_zoom + 1)
+                           if min(image.width, image.height) // 2 ** (image.max_zoom - zl)]
+        return Untiler.level_regions(image, zoom_levels, region)
+
+    # Returns {zoom_level: region} for the region of the image at each of zoom_levels. A region in pixels is given
+    # at the highest of these levels, and scaled down to the others. The levels where the region is smaller
+    # than a pixel are left out.
+    @staticmethod
+    def level_regions(image, zoom_levels, region=None):
+        top_level = max(zoom_levels)
+        levels = {}
+        for zoom_level in set(zoom_levels):
+            level_region = region
+            if region and not any(isinstance(v, float) for v in region):
+                factor = 2 ** (top_level - zoom_level)
+                left, top, right, bottom = region
+                level_region = left // factor, top // factor, math.ceil(right / factor), math.ceil(bottom / factor)
+            level = _UntileQuery(image, zoom_level)
+            left, top, right, bottom = _UntileQuery.region_box(level_region, level.width(), level.height())
+            if left < right and top < bottom:
+                levels[zoom_level] = level_region
+        if not levels:
+            raise ValueError(f"The region {region} does not intersect the image {image.file_name}.")
+        return levels
+
+    @staticmethod
+    def __tile_path(level_dir, query, index):
+        return Path(level_dir) / f'{index[0]}_{index[1]}.{query.image.format}'
+
+    @staticmethod
+    def __write_tile(level_dir, query, tile):
+        Untiler.__write_file(Untiler.__tile_path(level_dir, query, tile), tile[2])
+
+    @staticmethod
+    def __write_file(path, data):
+        # Written to a temporary file then renamed, so that an interrupted mirror never leaves a partial tile
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            Path(tmp_path).unlink()
+            raise
+
+    @staticmethod
+    def __is_cached(query):
+        return query.cache is not None and all(TileCache.key(query.image.tiles_url, query.zoom_level, *idx) in query.cache
+                                               for idx in query.tiles_urls())
+
+    @staticmethod
+    def __downsample(result, query):
+        with metrics.timed('downsample_seconds', image=query.image.file_name, zoom_level=query.zoom_level):
+            left, top, right, bottom = query.box()
+            content = result.content.resize((right - left, bottom - top), Image.LANCZOS)
+        # The tiles of the lower level covering a missing tile of the source are missing too,
+        # so that the downsampled level can be repaired with its own tiles.
+        # The last pixels of the source, when its size is odd, are squeezed into the last tiles of the lower level,
+        # and so are the pixels of a region scaled down to the first or last tiles of the lower level.
+        factor = 2 ** (result.query.zoom_level - query.zoom_level)
         tiles_urls = query.tiles_urls()
-        tile_matrix = {}
+        first_col, first_row = min(col for col, _ in tiles_urls), min(row for _, row in tiles_urls)
+        last_col, last_row = max(col for col, _ in tiles_urls), max(row for _, row in tiles_urls)
+        lower_tiles = {(col, row): (min(max(col // factor, first_col), last_col), min(max(row // factor, first_row), last_row))
+                       for col, row in result.failed_tiles}
+        failed_tiles = {idx: tiles_urls[idx] for idx in lower_tiles.values()}
+        return UntileResult(content, (len(tiles_urls) - len(failed_tiles)) / len(tiles_urls), query, failed_tiles)
+
+    @staticmethod
+    def __build_image(query: _UntileQuery, workers):
+        tiles_urls = query.tiles_urls()
+        mosaic = _Mosaic(query)
+        slots = _tile_slots
+
+        # Tiles are decoded as soon as they arrive and pasted, while the others are still downloading.
+        with cf.ThreadPoolExecutor(workers) as executor:
+            futures = {executor.submit(Untiler.__fetch_and_decode, query, idx, url, slots, mosaic.stopwatch): (idx, url)
+                       for idx, url in tiles_urls.items()}
+            for future in cf.as_completed(futures):
+                try:
+                    mosaic.paste(future.result())
+                except requests.exceptions.RequestException as err:
+                    mosaic.fail(*futures[future], err)
 
+        mosaic.stopwatch.emit('untile', image=query.image.file_name, zoom_level=query.zoom_level)
+        return mosaic.result(len(tiles_urls))
+
+    @staticmethod
+    def __stream_image(query: _UntileQuery, workers, path):
+        tiles_urls = query.tiles_urls()
+        rows = {}
         for idx, url in tiles_urls.items():
-            try:
-                tile = query.fetch_tile(idx, url)
-                tile_matrix[tile[0], tile[1]] = Image.open(BytesIO(tile[2]))
-            except requests.exceptions.RequestException as err:
-                log.error(f'Error: Unable to load tile {url} in position {idx}.\n' \
-                          f'Caused by {err}')
-        dims = (query.width(), query.height())
-        untiled = Image.new(MODES_FORMATS[query.image.format],dims)
+            rows.setdefault(idx[1], {})[idx] = url
 
+        left, top, right, bottom = query.box()
         t_size = query.image.tile_size
-        overlap = query.image.overlap
-        for index, tile in tile_matrix.items():
-            # FIX: Tiles of the firt column (resp. first row) seem to have
-            # no overlapping area on the left (resp. top) border.
-            overlap_x = query.image.overlap if index[0] else 0
-            overlap_y = query.image.overlap if index[1] else 0
-            crop_rectangle = (overlap_x,
-                              overlap_y,
-                              t_size + overlap_x,
-                              t_size + overlap_y)
-            non_overlapping = tile.crop(crop_rectangle)
-            cursor = (index[0] * t_size, index[1] * t_size)
-            untiled.paste(non_overlapping, box=cursor)
+        mode = MODES_FORMATS[query.image.format]
+        slots = _tile_slots
+        n_loaded = 0
+        failed_tiles = {}
+        stopwatch = metrics.Stopwatch()
+        # Rows of tiles not yet written. When the region does not start on the top of a row of tiles,
+        # the strips of the file and the rows of tiles are not aligned.
+        pending_rows = Image.new(mode, (right - left, 0))
 
-        # paint the grid on top of the image
-        if Untiler.DRAW_TILES_BOUNDS:
-            draw = ImageDraw.Draw(untiled)
-            for index, tile in tile_matrix.items():
-                cursor = (index[0] * t_size, index[1] * t_size)
-                # Draw boundaries with overlapping
-                tile_bbox = [cursor[0] - overlap, cursor[1] - overlap * 2, cursor[0] + tile.width - overlap,
-                             cursor[1] + tile.height - overlap * 2]
-                draw.rectangle(tile_bbox, outline='cyan')
-        return untiled, len(tile_matrix) / len(tiles_urls)
\ No newline at end of file
+        # Only one strip of tiles is held in memory. The tiles of the next strip
+        # are downloaded while the current one is assembled and written.
+        with cf.ThreadPoolExecutor(workers) as executor, \
+                StripTiffWriter(path, right - left, bottom - top, mode, t_size) as writer:
+
+            def submit(row):
+                return {executor.submit(Untiler.__fetch_and_decode, query, idx, url, slots, stopwatch): (idx, url)
+                        for idx, url in rows.get(row, {}).items()}
+
+            first_row, last_row = min(rows), max(rows)
+            pending = submit(first_row)
+            for row in range(first_row, last_row + 1):
+                upcoming = submit(row + 1)
+                strip = _Mosaic(query, box=(left, max(top, row * t_size), right, min(bottom, (row + 1) * t_size)),
+                                stopwatch=stopwatch)
+                for future in cf.as_completed(pending):
+                    try:
+                        strip.paste(future.result())
+                    except requests.exceptions.RequestException as err:
+                        strip.fail(*pending[future], err)
+                strip_image, _ = strip.result(len(pending))
+                pending_rows = Untiler.__stack(pending_rows, strip_image)
+                while pending_rows.height >= t_size or (row == last_row and pending_rows.height):
+                    with stopwatch.measure('write'):
+                        writer.write_strip(pending_rows.crop((0, 0, pending_rows.width, min(t_size, pending_rows.height))))
+                    pending_rows = pending_rows.crop((0, t_size, pending_rows.width, max(t_size, pending_rows.height)))
+                n_loaded += len(strip.tile_sizes)
+                failed_tiles.update(strip.failed_tiles)
+                pending = upcoming
+
+        stopwatch.emit('untile', image=query.image.file_name, zoom_level=query.zoom_level)
+        return UntileResult(path, n_loaded / len(tiles_urls), query, failed_tiles)
+
+    @staticmethod
+    def __fetch_and_decode(query, index, tile_url, slots, stopwatch):
+        with stopwatch.measure('fetch'):
+            tile = query.fetch_tile(index, tile_url, slots)
+        with stopwatch.measure('decode'):
+            return _Mosaic.decode(query, tile)
+
+    @staticmethod
+    def __stack(upper, lower):
+        if not upper.height:
+            return lower
+        image = Image.new(upper.mode, (upper.width, upper.height + lower.height))
+        image.paste(upper, (0, 0))
+        image.paste(lower, (0, upper.height))
+        return image
+
+    # Fetches again the tiles that could not be fetched when the result was untiled, and
+    # pastes them on the untiled image, or writes them to the TIFF file it was streamed to
+    # or to the directory they were mirrored to.
+    # The tiles still missing are fetched again up to retries times, waiting longer after each round.
+    @staticmethod
+    def repair(result, retries=REPAIR_RETRIES, workers=None):
+        query = result.query
+        content = result.content
+        failed_tiles = dict(result.failed_tiles)
+        n_tiles = len(query.tiles_urls())
+        slots = _tile_slots
+
+        with cf.ThreadPoolExecutor(workers or TILE_WORKERS) as executor:
+            for attempt in range(retries):
+                if not failed_tiles:
+                    break
+                if attempt:
+                    time.sleep(REPAIR_BACKOFF * 2 ** (attempt - 1))
+                log.info(f'Fetching {len(failed_tiles)} missing tile(s) of {query.image.file_name} ' \
+                         f'(attempt {attempt + 1}/{retries})')
+                futures = {executor.submit(query.fetch_tile, idx, url, slots): idx for idx, url in failed_tiles.items()}
+                for future in cf.as_completed(futures):
+                    try:
+                        tile = future.result()
+                    except requests.exceptions.RequestException as err:
+                        log.debug(f'Tile {futures[future]} of {query.image.file_name} is still missing: {err}')
+                        continue
+                    Untiler.__patch(content, query, tile)
+                    del failed_tiles[futures[future]]
+                    metrics.count('tiles_repaired_total')
+
+        return UntileResult(content, (n_tiles - len(failed_tiles)) / n_tiles, query, failed_tiles)
+
+    @staticmethod
+    def __patch(content, query, tile):
+        if not isinstance(content, Image.Image) and Path(content).is_dir():
+            Untiler.__write_tile(content, query, tile)
+            return
+        t_size = query.image.tile_size
+        col, row = tile[0], tile[1]
+        left, top, right, bottom = query.box()
+        box = (max(col * t_size, left), max(row * t_size, top),
+               min((col + 1) * t_size, right), min((row + 1) * t_size, bottom))
+        piece = _Mosaic(query, box=box)
+        piece.add(tile)
+        # The content only covers the region of the query
+        if isinstance(content, Image.Image):
+            content.paste(piece.image, box=(box[0] - left, box[1] - top))
+        else:
+            patch_strips(content, piece.image, box[0] - left, box[1] - top)
+
+
+class AsyncUntiler:
+
+    # Untiles an image like Untiler, awaiting the tiles instead of blocking on them.
+    # The tiles are fetched and decoded in the threads of the transport of the image.
+    @staticmethod
+    async def untile(image, zoom_level, workers=None, cache=None, region=None):
+        query = _UntileQuery(image,zoom_level, cache, region)
+        atransport = (image.transport or default_transport()).asynchronous()
+        tiles_urls = query.tiles_urls()
+        mosaic = _Mosaic(query)
+        slots = _tile_slots
+        image_slots = asyncio.Semaphore(workers or TILE_WORKERS)
+
+        async def fetch_and_add(idx, url):
+            async with image_slots:
+                try:
+                    with mosaic.stopwatch.measure('fetch'):
+                        tile = await atransport.run(query.fetch_tile, idx, url, slots)
+                except requests.exceptions.RequestException as err:
+                    mosaic.fail(idx, url, err)
+                    return
+            await asyncio.get_running_loop().run_in_executor(None, mosaic.add, tile)
+
+        await asyncio.gather(*(fetch_and_add(idx, url) for idx, url in tiles_urls.items()))
+        mosaic.stopwatch.emit('untile', image=query.image.file_name, zoom_level=query.zoom_level)
+        return mosaic.result(len(tiles_urls))
@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+import concurrent.futures as cf
+import logging as log
+from dataclasses import dataclass
+from pathlib import Path
+
+LEASE_DURATION = 120 # in seconds, a job not renewed within this delay is given to another worker
+MAX_ATTEMPTS = 3 # Number of times a job is leased before it is marked as failed
+POLL_INTERVAL = 2 # in seconds, how often an idle worker looks for new jobs
+QUEUE_WORKERS = 4 # Number of jobs run at once by a worker
+SQLITE_TIMEOUT = 60 # in seconds, how long a worker waits for the others to release the database
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+QUEUE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    UNIQUE (kind, key)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until);
+'''
+
+
+@dataclass(frozen=True)
+class Job:
+    id: int
+    kind: str
+    key: str
+    payload: dict
+    attempts: int
+
+
+def worker_name():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class WorkQueue:
+
+    # A queue of jobs stored in a SQLite file, shared by workers running in several processes.
+    # A job is leased by one worker at a time, for lease_duration seconds. A worker renews the leases of
+    # the jobs it is running, so the jobs of a worker that crashed are leased again by the others once
+    # their lease expires. A job leased max_attempts times without completing is marked as failed.
+    # Each job is identified by its kind and key, a job put again is ignored.
+    # SQLite locks are not reliable on every network filesystem, check the one the queue is shared on.
+    def __init__(self, path, lease_duration=LEASE_DURATION, max_attempts=MAX_ATTEMPTS):
+        self.path = Path(path)
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+        self.__lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.executescript(QUEUE_SCHEMA)
+
+    def __transaction(self, fn, *args):
+        # BEGIN IMMEDIATE takes the write lock of the database at once, so that two workers never lease the same job
+        with self.__lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(*args)
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+            return result
+
+    def put(self, jobs):
+        # jobs is an iterable of (kind, key, payload)
+        rows = [(kind, key, json.dumps(payload, ensure_ascii=False)) for kind, key, payload in jobs]
+        self.__transaction(self.__put, rows)
+
+    def __put(self, rows):
+        self.connection.executemany('INSERT OR IGNORE INTO jobs (kind, key, payload) VALUES (?, ?, ?)', rows)
+
+    def lease(self, worker, n=1):
+        return self.__transaction(self.__lease, worker, n)
+
+    def __lease(self, worker, n):
+        now = time.time()
+        rows = self.connection.execute(
+            'SELECT id, kind, key, payload, attempts FROM jobs '
+            'WHERE state = ? OR (state = ? AND lease_until < ?) ORDER BY id LIMIT ?',
+            (PENDING, LEASED, now, n)).fetchall()
+        jobs = []
+        for job_id, kind, key, payload, attempts in rows:
+            if attempts >= self.max_attempts:
+                log.error(f'Error: Job {kind} {key} failed {attempts} times, giving up.')
+                self.connection.execute('UPDATE jobs SET state = ?, worker = NULL WHERE id = ?', (FAILED, job_id))
+                continue
+            self.connection.execute('UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = ? WHERE id = ?',
+                                    (LEASED, worker, now + self.lease_duration, attempts + 1, job_id))
+            jobs.append(Job(job_id, kind, key, json.loads(payload), attempts + 1))
+        return jobs
+
+    def heartbeat(self, worker, jobs):
+        # Renews the leases of the jobs still leased by worker
+        until = time.time() + self.lease_duration
+        rows = [(until, job.id, worker, LEASED) for job in jobs]
+        self.__transaction(self.__heartbeat, rows)
+
+    def __heartbeat(self, rows):
+        self.connection.executemany('UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = ?', rows)
+
+    def complete(self, worker, job, new_jobs=()):
+        # The new jobs are put in the same transaction, so they are lost neither if the worker crashes
+        # nor if the job was leased by another worker in the meantime.
+        rows = [(kind, key, json.dumps(payload, ensure_ascii=False)) for kind, key, payload in new_jobs]
+        return self.__transaction(self.__complete, worker, job, rows)
+
+    def __complete(self, worker, job, rows):
+        self.__put(rows)
+        cursor = self.connection.execute('UPDATE jobs SET state = ?, error = NULL WHERE id = ? AND worker = ? AND state = ?',
+                                         (DONE, job.id, worker, LEASED))
+        return bool(cursor.rowcount)
+
+    def fail(self, worker, job, error):
+        # The job is leased again later, until it is leased max_attempts times
+        self.__transaction(self.__fail, worker, job, str(error))
+
+    def __fail(self, worker, job, error):
+        self.connection.execute('UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL, error = ? '
+                                'WHERE id = ? AND worker = ? AND state = ?',
+                                (PENDING if job.attempts < self.max_attempts else FAILED, error, job.id, worker, LEASED))
+
+    def counts(self):
+        with self.__lock:
+            return dict(self.connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def is_finished(self):
+        # No job is waiting or running anywhere
+        counts = self.counts()
+        return not counts.get(PENDING) and not counts.get(LEASED)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class QueueWorker:
+
+    # Runs the jobs of a work queue, up to workers jobs at once, until no job is waiting or running.
+    # handle(job) runs a job and returns an iterable of new (kind, key, payload) jobs to put in the queue.
+    # Jobs raising an exception are given back to the queue, to be tried again later.
+    def __init__(self, work_queue, handle, workers=QUEUE_WORKERS, name=None, poll_interval=POLL_INTERVAL):
+        self.queue = work_queue
+        self.handle = handle
+        self.workers = workers
+        self.name = name or worker_name()
+        self.poll_interval = poll_interval
+        self.running = {}
+        self.n_done = 0
+        self.n_failed = 0
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+
+    def run(self):
+        heartbeat = threading.Thread(target=self.__heartbeat, name=f'{self.name}-heartbeat', daemon=True)
+        heartbeat.start()
+        try:
+            with cf.ThreadPoolExecutor(self.workers) as executor:
+                futures = set()
+                while True:
+                    free = self.workers - len(futures)
+                    jobs = self.queue.lease(self.name, free) if free else []
+                    for job in jobs:
+                        with self.__lock:
+                            self.running[job.id] = job
+                        futures.add(executor.submit(self.__run_job, job))
+
+                    if not futures:
+                        if self.queue.is_finished():
+                            break
+                        # Other workers may still put new jobs, or crash and leave their jobs to lease again
+                        time.sleep(self.poll_interval)
+                        continue
+                    # Once all the workers are busy, no job is leased until one of them is done
+                    timeout = self.poll_interval if len(futures) < self.workers else None
+                    _, futures = cf.wait(futures, timeout=timeout, return_when=cf.FIRST_COMPLETED)
+        finally:
+            self.__stopped.set()
+        log.info(f'Worker {self.name} is done: {self.n_done} job(s) completed, {self.n_failed} job(s) failed')
+
+    def __run_job(self, job):
+        try:
+            try:
+                new_jobs = list(self.handle(job) or [])
+            except Exception as err:
+                log.error(f'Error: Job {job.kind} {job.key} failed (attempt {job.attempts}).\n' \
+                          f'Caused by {err}')
+                self.queue.fail(self.name, job, err)
+                with self.__lock:
+                    self.n_failed += 1
+                return
+            if not self.queue.complete(self.name, job, new_jobs):
+                log.warning(f'The lease of job {job.kind} {job.key} expired before it was completed')
+            with self.__lock:
+                self.n_done += 1
+        finally:
+            with self.__lock:
+                del self.running[job.id]
+
+    def __heartbeat(self):
+        while not self.__stopped.wait(self.queue.lease_duration / 3):
+            with self.__lock:
+                jobs = list(self.running.values())
+            if jobs:
+                try:
+                    self.queue.heartbeat(self.name, jobs)
+                except sqlite3.Error as err:
+                    log.warning(f'Unable to renew the leases of worker {self.name}: {err}')
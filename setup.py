@@ -8,7 +8,7 @@ def read(fname):
 
 
 setup(
-    python_requires='>3.6',
+    python_requires='>=3.7',
     name='grabs',
     version='0.1',
     description='Grab documents and images from http://bibliotheques-specialisees.paris.fr',
@@ -23,10 +23,14 @@ setup(
         'Pillow',
         'dataclasses'
     ],
+    extras_require={
+        'lxml': ['lxml'],
+    },
     classifiers=[],
     entry_points='''
         [console_scripts]
         grabs=cli:grab
+        grabs-queue=cli:queue
     ''',
     project_urls={
         "Documentation": "https://github.com/HueyNemud/python-grabs",
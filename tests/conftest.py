@@ -0,0 +1,17 @@
+import sys
+import pytest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'benchmarks'))
+import fakeserver
+
+
+# The fake library of the benchmarks, served for the tests that send requests
+@pytest.fixture
+def library():
+    library = fakeserver.FakeLibrary()
+    server, root = fakeserver.serve(library)
+    library.root = root
+    yield library
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,61 @@
+import os
+import pytest
+import requests
+import fakeserver
+import grabs
+from grabs.cache import (TileCache, ResponseCache)
+from grabs.metrics import Metrics
+from grabs.transport import OfflineError
+
+
+def test_least_recently_used_tiles_evicted(tmp_path):
+    cache = TileCache(tmp_path, max_size=450)
+    keys = [TileCache.key('tiles', 13, col, 0) for col in range(5)]
+    for idx, key in enumerate(keys[:4]):
+        cache.put(key, bytes(100))
+        os.utime(cache.path(key), (1000 * (idx + 1), 1000 * (idx + 1)))
+    assert cache.get(keys[0]) == bytes(100) # Now the most recently used
+    # Once larger than 450 bytes, the cache is shrunk to 90% of it, i.e. 4 tiles
+    cache.put(keys[4], bytes(100))
+    assert [key in cache for key in keys] == [True, False, True, True, True]
+    assert cache.get(keys[1]) is None
+
+
+def test_size_measured_from_the_files(tmp_path):
+    # Tiles written by another process count in the size of the cache
+    TileCache(tmp_path).put(TileCache.key('tiles', 13, 0, 0), bytes(300))
+    cache = TileCache(tmp_path, max_size=450)
+    cache.put(TileCache.key('tiles', 13, 1, 0), bytes(200))
+    assert len(list(tmp_path.glob('*/*'))) == 1
+    cache.clear()
+    assert not list(tmp_path.glob('*/*'))
+
+
+def test_responses_revalidated_with_etag(library, tmp_path):
+    url = f'{library.root}/{fakeserver.ark(1)}'
+    transport = grabs.Transport(root=library.root, response_cache=ResponseCache(tmp_path, ttl=3600))
+    text = transport.get_cached(url).text
+    assert transport.get_cached(url).text == text # Fresh, not requested again
+    assert library.requests[f'/{fakeserver.ark(1)}'] == 1
+
+    # Once stale, the server is asked whether the response changed, and it answers 304 Not Modified
+    stale = ResponseCache(tmp_path, ttl=0)
+    transport.response_cache = stale
+    with Metrics() as collector:
+        assert transport.get_cached(url).text == text
+    assert collector.counters[('response_cache_total', (('result', 'revalidated'),))] == 1
+    assert library.requests[f'/{fakeserver.ark(1)}'] == 2
+    assert stale.get(url).headers['ETag'] and stale.get(url).content == text.encode()
+
+
+def test_responses_read_offline(tmp_path):
+    cache = ResponseCache(tmp_path, ttl=0)
+    transport = grabs.Transport(root='http://127.0.0.1:9', response_cache=cache, offline=True)
+    with pytest.raises(OfflineError):
+        transport.get_cached('http://127.0.0.1:9/page')
+    response = requests.Response()
+    response.status_code, response._content, response.encoding = 200, b'page', 'utf-8'
+    response.headers['ETag'] = '"1"'
+    cache.put('http://127.0.0.1:9/page', response)
+    # Stale responses are used as they are while offline
+    assert transport.get_cached('http://127.0.0.1:9/page').text == 'page'
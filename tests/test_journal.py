@@ -0,0 +1,50 @@
+import fakeserver
+import cli
+from click.testing import CliRunner
+from grabs.journal import (Journal, JOURNAL_FILE_NAME)
+
+
+def test_images_journaled_in_out_dir(library, tmp_path, monkeypatch):
+    # The image is journaled by its path in the output directory, however the directory is written
+    monkeypatch.chdir(tmp_path)
+    args = ['-s', f'{library.root}/{fakeserver.ark(1)}/v0001', '-z', '11', '--root-url', library.root,
+            '--cache-dir', 'cache', '--no-metadata-cache']
+    for out_dir in ('out', './out', f'{tmp_path}/out/'):
+        assert CliRunner().invoke(cli.grab, args + ['-o', out_dir]).exit_code == 0
+        with Journal(tmp_path / 'out' / JOURNAL_FILE_NAME, resume=True) as journal:
+            assert ('image', 'pf0000000001_1.jpg') in journal
+
+
+def test_records_read_after_reopen(tmp_path):
+    path = tmp_path / JOURNAL_FILE_NAME
+    with Journal(path) as journal:
+        journal.add('document', 'a', children_urls=['b'], with_images=True)
+        journal.add('image', 'a.jpg')
+        journal.add('document', 'a', children_urls=['b', 'c'], with_images=True) # The last record of a key wins
+    with Journal(path, resume=True) as journal:
+        assert journal.get('document', 'a') == {'kind': 'document', 'key': 'a', 'children_urls': ['b', 'c'], 'with_images': True}
+        assert journal.get('image', 'a.jpg') == {'kind': 'image', 'key': 'a.jpg'}
+        assert journal.get('image', 'b.jpg') is None
+        journal.add('image', 'b.jpg')
+        assert journal.get('image', 'b.jpg') == {'kind': 'image', 'key': 'b.jpg'}
+    # Without resume, the records of the previous job are discarded
+    with Journal(path) as journal:
+        assert ('image', 'a.jpg') not in journal
+    with Journal(path, resume=True) as journal:
+        assert ('image', 'a.jpg') not in journal
+
+
+def test_line_cut_by_a_crash(tmp_path):
+    path = tmp_path / JOURNAL_FILE_NAME
+    with Journal(path) as journal:
+        journal.add('image', 'a.jpg')
+    with open(path, 'ab') as file:
+        file.write(b'{"kind": "image", "ke')
+    with Journal(path, resume=True) as journal:
+        assert list(journal.offsets) == [('image', 'a.jpg')]
+        journal.add('image', 'b.jpg')
+    # The next record starts on a line of its own, and the offsets are right after the cut line
+    with Journal(path, resume=True) as journal:
+        assert set(journal.offsets) == {('image', 'a.jpg'), ('image', 'b.jpg')}
+        assert journal.get('image', 'b.jpg') == {'kind': 'image', 'key': 'b.jpg'}
+        assert journal.get('image', 'a.jpg') == {'kind': 'image', 'key': 'a.jpg'}
@@ -0,0 +1,75 @@
+import threading
+import pytest
+import fakeserver
+import cli
+from click.testing import CliRunner
+from grabs.journal import (Journal, JOURNAL_FILE_NAME)
+from grabs.pipeline import Pipeline
+
+
+def run(pipeline, items, timeout=5):
+    # Fails instead of hanging if the pipeline never ends
+    thread = threading.Thread(target=pipeline.run, args=(items,), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive()
+
+
+def test_items_through_the_stages():
+    # Each stage ends once the stage before it is done, whatever the number of workers
+    done = []
+    lock = threading.Lock()
+
+    def split(item):
+        yield from range(item)
+
+    def collect(item):
+        with lock:
+            done.append(item)
+
+    pipeline = Pipeline()
+    pipeline.add_stage('split', split, workers=3, queue_size=1)
+    pipeline.add_stage('double', lambda item: [2 * item], workers=2, queue_size=1)
+    pipeline.add_stage('collect', collect, workers=4, queue_size=1)
+    run(pipeline, [1, 2, 3])
+    assert sorted(done) == [0, 0, 0, 2, 2, 4]
+    run(pipeline, []) # Also ends without items
+
+
+def test_errors_passed_to_the_handler():
+    errors = []
+    done = []
+    pipeline = Pipeline(on_error=lambda stage, item, err: errors.append((stage, item, type(err))))
+    pipeline.add_stage('parse', lambda item: [int(item)])
+    pipeline.add_stage('collect', lambda item: done.append(item))
+    run(pipeline, ['1', 'x', '2'])
+    assert done == [1, 2]
+    assert errors == [('parse', 'x', ValueError)]
+    with pytest.raises(ValueError):
+        pipeline.add_stage('none', lambda item: [], workers=0)
+
+
+def test_failing_error_handler():
+    def on_error(stage, item, err):
+        raise RuntimeError(f'{stage} failed on {item}')
+
+    done = []
+    pipeline = Pipeline(on_error=on_error)
+    pipeline.add_stage('parse', lambda item: [1 / item], workers=2, queue_size=1)
+    pipeline.add_stage('collect', lambda item: done.append(item), workers=2, queue_size=1)
+    run(pipeline, [0] * 10 + [1, 2, 4])
+    assert sorted(done) == [0.25, 0.5, 1]
+
+
+def test_unexpected_image_error(library, tmp_path, monkeypatch, caplog):
+    # The images are counted as failed, and their document is not journaled
+    def untile_image(*args, **kwargs):
+        raise RuntimeError('Unexpected')
+
+    monkeypatch.setattr(cli, 'untile_image', untile_image)
+    result = CliRunner().invoke(cli.grab, ['-s', f'{library.root}/{fakeserver.ark(1)}', '-o', str(tmp_path), '--root-url', library.root,
+                                           '--no-cache', '--no-metadata-cache'])
+    assert result.exit_code == 0
+    assert f'0/{fakeserver.IMAGES} images' in caplog.text
+    with Journal(tmp_path / JOURNAL_FILE_NAME, resume=True) as journal:
+        assert not journal.offsets
@@ -0,0 +1,54 @@
+import statistics
+import pytest
+from grabs import ratelimit
+from grabs.ratelimit import (HostLimiter, request_class)
+
+TILE_URL = 'https://example.org/in/dz/pf0000000001_1/13/4_2.jpg'
+PAGE_URL = 'https://example.org/ark:/73873/pf0000000001'
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def run(limiter, clock, requests):
+    # Sends the (url, latency) requests one after the other, as if limit of them ran at once
+    limits = []
+    for url, latency in requests:
+        limiter.acquire()
+        clock.now += latency / limiter.limit
+        limiter.release(latency, request_class=request_class(url))
+        limits.append(limiter.limit)
+    return limits
+
+
+def test_request_class():
+    assert request_class(TILE_URL) == 'jpg'
+    assert request_class(PAGE_URL) == request_class(PAGE_URL + '/v0001') == '/ark:/73873'
+    assert request_class('https://example.org/in/rest/pictureListSVC/getTileSource?deepZoomManifest=x.xml') == '/in/rest'
+
+
+def test_large_pages_do_not_slow_down_tiles(clock):
+    # One slow page every 20 fast tiles, on a server that never slows down
+    limiter = HostLimiter('example.org', 40)
+    requests = [(PAGE_URL, 0.3) if k % 20 == 0 else (TILE_URL, 0.02) for k in range(2000)]
+    assert statistics.mean(run(limiter, clock, requests)) > 35
+
+
+def test_slow_server(clock):
+    limiter = HostLimiter('example.org', 40)
+    run(limiter, clock, [(TILE_URL, 0.02)] * 200)
+    limits = run(limiter, clock, [(TILE_URL, 0.2)] * 50)
+    assert min(limits) < 10
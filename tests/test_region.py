@@ -0,0 +1,58 @@
+import click
+import pytest
+import fakeserver
+import grabs
+import cli
+from PIL import Image
+from grabs.resource import TiledImage
+from grabs.untiler import _UntileQuery
+
+
+def image(width=1000, height=800):
+    return TiledImage(iid='1', ark='ark:/73873/pf0000000001/v0001', manifest_url='', tiles_url='tiles',
+                      file_name='image.jpg', width=width, height=height, tile_size=256, overlap=1)
+
+
+@pytest.mark.parametrize('value, region', [
+    ('10,20,300,400', (10, 20, 300, 400)),
+    ('0.0,0.0,0.5,0.5', (0.0, 0.0, 0.5, 0.5)),
+    ('0.5,0.5,1,1', (0.5, 0.5, 1.0, 1.0)), # Integers among fractions are fractions too
+    ('0,0,0.5,0.5', (0.0, 0.0, 0.5, 0.5)),
+])
+def test_parse_region(value, region):
+    parsed = cli.parse_region(None, None, value)
+    assert parsed == region
+    assert [type(v) for v in parsed] == [type(v) for v in region]
+
+
+@pytest.mark.parametrize('value', ['0.5,0.5,100,100', '1,2,3', 'a,b,c,d', '1e3,0,10,10'])
+def test_parse_region_rejects(value):
+    with pytest.raises(click.BadParameter):
+        cli.parse_region(None, None, value)
+
+
+def test_mixed_region_is_fractions():
+    im = image()
+    assert _UntileQuery(im, im.max_zoom, region=(0.5, 0.5, 1, 1)).box() == (500, 400, 1000, 800)
+    assert _UntileQuery(im, im.max_zoom, region=(0, 0, 0.5, 0.5)).box() == (0, 0, 500, 400)
+    with pytest.raises(ValueError):
+        _UntileQuery(im, im.max_zoom, region=(0.5, 0.5, 100, 100))
+
+
+def test_region_in_file_name():
+    im = image()
+    assert cli.image_path('out', im) == 'out/image.jpg'
+    assert cli.image_path('out', im, region=(0.5, 0.5, 1.0, 1.0)) == 'out/image_region0.5-0.5-1.0-1.0.jpg'
+    assert cli.image_paths('out', im, [11, 10], region=(0, 0, 10, 10)) == \
+        {11: 'out/image_z11_region0-0-10-10.jpg', 10: 'out/image_z10_region0-0-10-10.jpg'}
+
+
+def test_region_saved_at_each_level(library, tmp_path):
+    transport = grabs.Transport(root=library.root)
+    im = grabs.tiled_image(f'{library.root}/{fakeserver.ark(1)}/v0001', transport=transport)
+    untiled = cli.untile_image(tmp_path, im, [13, 12], caching=False, region=(0, 0, 600, 400))
+    cli.save_image(im, untiled)
+    # The pixels are given at level 13, and halved at level 12
+    sizes = {path: Image.open(path).size for path, _ in untiled}
+    assert sizes == {cli.image_path(tmp_path, im, zoom_level=13, region=(0, 0, 600, 400)): (600, 400),
+                     cli.image_path(tmp_path, im, zoom_level=12, region=(0, 0, 600, 400)): (300, 200)}
@@ -0,0 +1,39 @@
+import re
+import asyncio
+import fakeserver
+import grabs
+from grabs.resource import (DocumentBuilder, AsyncDocumentBuilder, CHILDREN_WORKERS)
+
+
+def test_images_of_a_document_have_a_parent(library):
+    transport = grabs.Transport(root=library.root)
+    url = f'{library.root}/{fakeserver.ark(1)}'
+    for doc in (DocumentBuilder(url, transport=transport).build(),
+                asyncio.run(AsyncDocumentBuilder(url, transport=transport).build())):
+        assert len(doc.images) == fakeserver.IMAGES
+        assert all(im.parent_url == url for im in doc.images)
+    # Built from its viewer, an image has the same parent
+    assert grabs.tiled_image(f'{url}/v0002', transport=transport).parent_url == url
+
+
+def test_achildren_are_built_a_few_ahead(library):
+    library.fanout = 3 * CHILDREN_WORKERS
+    transport = grabs.Transport(root=library.root)
+    url = f'{library.root}/{fakeserver.ark(1)}'
+
+    async def first_child():
+        doc = await AsyncDocumentBuilder(url, transport=transport).build()
+        children = doc.achildren
+        child = await children.__anext__()
+        await children.aclose()
+        # The children built ahead are cancelled when the consumer stops
+        ahead = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.wait(ahead, timeout=5)
+        assert ahead and all(task.cancelled() for task in ahead)
+        return doc, child
+
+    doc, child = asyncio.run(first_child())
+    assert len(doc.children_urls) == 3 * CHILDREN_WORKERS
+    assert child.url == doc.children_urls[0]
+    pages = [page for page in library.requests if re.search(r'/pf\d{10}$', page)]
+    assert len(pages) <= 1 + CHILDREN_WORKERS # The document and the children built ahead
@@ -0,0 +1,52 @@
+import pytest
+from PIL import Image
+from grabs.tiff import (StripTiffWriter, patch_strips)
+
+
+def gradient(width, height, mode='RGB'):
+    bands = [Image.new('L', (width, height)) for _ in mode]
+    for k, band in enumerate(bands):
+        band.putdata([(x * 7 + y * 3 + k * 50) % 256 for y in range(height) for x in range(width)])
+    return Image.merge(mode, bands)
+
+
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'RGBA'])
+def test_write_strips(tmp_path, mode):
+    # The last strip is shorter than the others
+    image = gradient(70, 50, mode)
+    path = tmp_path / 'image.tif'
+    with StripTiffWriter(path, 70, 50, mode, 16) as writer:
+        for top in range(0, 50, 16):
+            writer.write_strip(image.crop((0, top, 70, min(top + 16, 50))))
+    with Image.open(path) as tiff:
+        assert tiff.mode == mode
+        assert tiff.tobytes() == image.tobytes()
+
+
+def test_strips_checked(tmp_path):
+    with pytest.raises(ValueError):
+        StripTiffWriter(tmp_path / 'image.tif', 10, 10, 'P', 4)
+    writer = StripTiffWriter(tmp_path / 'image.tif', 10, 10, 'RGB', 4)
+    with pytest.raises(ValueError):
+        writer.write_strip(gradient(10, 3)) # Not the last strip
+    with pytest.raises(ValueError):
+        writer.write_strip(gradient(10, 4, 'L'))
+    writer.write_strip(gradient(10, 4))
+    with pytest.raises(ValueError): # Rows are missing
+        writer.close()
+
+
+def test_patch_strips(tmp_path):
+    # The patch spans two strips
+    path = tmp_path / 'image.tif'
+    with StripTiffWriter(path, 40, 30, 'RGB', 8) as writer:
+        for top in range(0, 30, 8):
+            writer.write_strip(Image.new('RGB', (40, min(8, 30 - top)), 'white'))
+    patch = gradient(12, 10)
+    patch_strips(path, patch, 5, 6)
+    expected = Image.new('RGB', (40, 30), 'white')
+    expected.paste(patch, (5, 6))
+    with Image.open(path) as tiff:
+        assert tiff.tobytes() == expected.tobytes()
+    with pytest.raises(ValueError):
+        patch_strips(path, gradient(2, 2, 'L'), 0, 0)
@@ -0,0 +1,66 @@
+import re
+from io import BytesIO
+import pytest
+import fakeserver
+import grabs
+from PIL import Image
+from grabs.resource import TiledImage
+from grabs.untiler import (Untiler, UntileResult, _UntileQuery, _Mosaic, MODES_FORMATS)
+
+
+def image(width=1000, height=800, format='jpg'):
+    return TiledImage(iid='1', ark='ark:/73873/pf0000000001/v0001', manifest_url='', tiles_url='tiles',
+                      file_name=f'image.{format}', format=format, width=width, height=height, tile_size=256, overlap=1)
+
+
+def encode(tile, format):
+    buffer = BytesIO()
+    tile.save(buffer, format)
+    return buffer.getvalue()
+
+
+def test_palette_tile():
+    # The palette of a tile is kept when its pixels are sent back from the decoding processes
+    tile = Image.new('P', (257, 257))
+    tile.putpalette([0, 0, 0, 200, 30, 40] + [0] * 762)
+    tile.paste(1, (0, 0, 257, 257))
+    query = _UntileQuery(image(format='png'), 11)
+    mosaic = _Mosaic(query, box=(0, 0, 256, 256))
+    mosaic.add((0, 0, encode(tile, 'PNG')))
+    assert mosaic.image.mode == MODES_FORMATS['png']
+    assert mosaic.image.getpixel((10, 10)) == (200, 30, 40, 255)
+
+
+def test_downsample_failed_last_tile():
+    # At level 11 the image is 513 pixels wide, and its third column of tiles holds only the last pixel.
+    # At level 10, it is 256 pixels wide, with a single column of tiles.
+    im = image(width=513, height=300)
+    source = _UntileQuery(im, 11)
+    failed_tiles = {(2, 0): source.tiles_urls()[2, 0]}
+    result = UntileResult(Image.new('RGB', (513, 300)), 5 / 6, source, failed_tiles)
+    lower = Untiler._Untiler__downsample(result, _UntileQuery(im, 10))
+    assert lower.content.size == (256, 150)
+    assert lower.failed_tiles == {(0, 0): 'tiles/10/0_0.jpg'}
+    assert lower.success_rate == 0
+
+
+def test_mirror_levels():
+    im = image(width=3000, height=2200) # Levels 2 to 13
+    assert sorted(Untiler.mirror_levels(im)) == list(range(2, 14))
+    # A tenth of the image is less than a pixel wide below level 4
+    assert sorted(Untiler.mirror_levels(im, region=(0.1, 0.1, 0.2, 0.2))) == list(range(4, 14))
+    # Pixels are given at the highest level and scaled down to the others
+    levels = Untiler.mirror_levels(im, [13, 12, 11], region=(500, 500, 1201, 900))
+    assert levels == {13: (500, 500, 1201, 900), 12: (250, 250, 601, 450), 11: (125, 125, 301, 225)}
+    with pytest.raises(ValueError):
+        Untiler.mirror_levels(im, region=(4000, 4000, 5000, 5000))
+
+
+def test_pyramid_region(library):
+    transport = grabs.Transport(root=library.root)
+    im = grabs.tiled_image(f'{library.root}/{fakeserver.ark(1)}/v0001', transport=transport)
+    results = im.pyramid([13, 12, 11], caching=False, region=(0, 0, 600, 400))
+    assert {zl: result.content.size for zl, result in results.items()} == {13: (600, 400), 12: (300, 200), 11: (150, 100)}
+    # Only the tiles of the region at the highest level are fetched
+    tiles = [tuple(map(int, m.groups())) for m in map(re.compile(r'/(\d+)/(\d+)_(\d+)\.jpg$').search, library.requests) if m]
+    assert sorted(tiles) == [(13, col, row) for col in range(3) for row in range(2)]
@@ -0,0 +1,79 @@
+import pytest
+from grabs import workqueue
+from grabs.workqueue import (WorkQueue, QueueWorker, PENDING, LEASED, DONE, FAILED)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(workqueue.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def work_queue(tmp_path):
+    with WorkQueue(tmp_path / 'jobs.sqlite', lease_duration=60, max_attempts=2) as work_queue:
+        yield work_queue
+
+
+def test_lease_expires(clock, work_queue):
+    work_queue.put([('image', 'a', {'url': 'a'}), ('image', 'b', {}), ('image', 'a', {})]) # A job put again is ignored
+    jobs = work_queue.lease('w1', 5)
+    assert [(job.key, job.payload, job.attempts) for job in jobs] == [('a', {'url': 'a'}, 1), ('b', {}, 1)]
+    assert work_queue.lease('w2', 5) == []
+    # The worker w1 stopped answering, its jobs are given to w2 once their lease expires
+    clock[0] += 61
+    jobs = work_queue.lease('w2', 1)
+    assert [(job.key, job.attempts) for job in jobs] == [('a', 2)]
+    assert not work_queue.complete('w1', jobs[0]) # No longer leased by w1
+    assert work_queue.complete('w2', jobs[0], [('image', 'c', {})])
+    assert work_queue.counts() == {DONE: 1, LEASED: 1, PENDING: 1}
+
+
+def test_heartbeat_renews_the_lease(clock, work_queue):
+    work_queue.put([('image', 'a', {})])
+    jobs = work_queue.lease('w1')
+    clock[0] += 50
+    work_queue.heartbeat('w1', jobs)
+    work_queue.heartbeat('w2', jobs) # Only the leases of the worker are renewed
+    clock[0] += 50
+    assert work_queue.lease('w2') == []
+    clock[0] += 11
+    assert [job.key for job in work_queue.lease('w2')] == ['a']
+
+
+def test_failed_job_requeued(clock, work_queue):
+    work_queue.put([('image', 'a', {})])
+    job, = work_queue.lease('w1')
+    work_queue.fail('w1', job, ValueError('Tiles are missing'))
+    assert work_queue.counts() == {PENDING: 1}
+    job, = work_queue.lease('w1')
+    assert job.attempts == 2
+    # After max_attempts leases, the job is given up
+    work_queue.fail('w1', job, ValueError('Tiles are missing'))
+    assert work_queue.counts() == {FAILED: 1}
+    assert work_queue.is_finished()
+    # A job whose lease expired max_attempts times is given up when it would be leased again
+    work_queue.put([('image', 'b', {})])
+    work_queue.lease('w1')
+    clock[0] += 61
+    work_queue.lease('w1')
+    clock[0] += 61
+    assert work_queue.lease('w1') == []
+    assert work_queue.counts() == {FAILED: 2}
+
+
+def test_worker_runs_until_finished(work_queue):
+    # Each document job queues its children, down to depth 2; the job 'b' fails on its first attempt
+    attempts = []
+
+    def handle(job):
+        attempts.append(job.key)
+        if job.key == 'b' and job.attempts == 1:
+            raise ValueError('Tiles are missing')
+        return [('document', job.key + child, {}) for child in 'ab'] if len(job.key) < 2 else []
+
+    work_queue.put([('document', 'a', {}), ('document', 'b', {})])
+    QueueWorker(work_queue, handle, workers=3, poll_interval=0.01).run()
+    assert work_queue.counts() == {DONE: 6}
+    assert sorted(attempts) == ['a', 'aa', 'ab', 'b', 'b', 'ba', 'bb']